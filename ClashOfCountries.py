@@ -7,10 +7,12 @@ import sys
 import pickle
 from time import time
 from math import log10, sin, cos
-import json
+import base64
 from hashlib import sha256
 import threading
 import rsa
+from protocol import frame, FrameBuffer, FrameError, SessionCipher, encryptMessage, decryptMessage, saveKeyFile, loggable
+from codec import JsonCodec, BinaryCodec, UnauthorisedCodecError
 
 # Below are the colour values used
 
@@ -20,6 +22,8 @@ BLACK = "#000000"
 WHITE = "#ffffff"
 
 AUTH = str(sha256("121212".encode("ascii"), usedforsecurity=True).digest()) #A hash used as an authorisation code for sending and receiving messages
+JSONCODEC = JsonCodec(AUTH) #Used until the binary codec has been agreed with the server at login
+BINARYCODEC = BinaryCodec()
 
 # This is the multiplier for how the velocity of the card should decrease every time the card is updated.
 # This results in an exponential graph of the order y = 1/x
@@ -619,7 +623,7 @@ class MajorFortificationBuff(FortificationBuff, MajorBuff):
     "Subclass for Major Fortification Buffs that inherits from FortificationBuff and MajorBuff. +2 increase"
     def __init__(self, player: bool):
         
-        super(MajorFortificationBuff).__init__(2, player)
+        super(MajorFortificationBuff, self).__init__(2, player)
         self.setSymbol()
 
 class AttackBuff(MultiplicativeBuff):
@@ -1039,9 +1043,10 @@ class Connection:
         self.SOCK = s.socket(s.AF_INET, s.SOCK_STREAM)
         self.regularSock = self.SOCK
         self.regularSock.settimeout(1) #Sets the socket timeout to 1 second
+        self.regularBuffer = FrameBuffer() #Holds any part of a message that has arrived before the rest of it
+        self.buffer = self.regularBuffer #The buffer for whichever socket is currently in use
         for event in GAME.getevent(): #Iterates through the game events to keep the game up to date
             pass
-        self.__PUBLICKEY, self.__PRIVATEKEY = rsa.newkeys(2048) #Generate keys 
         failed = True
         errorcount = 0 #Try to connect, making sure to check game events each time
         while failed:
@@ -1055,50 +1060,74 @@ class Connection:
                 errorcount += 1
             if errorcount == 10: #If the connection cannot be made after 10 attempts, raise an error
                 raise er.InitialConnectionError
-        self.SOCK.send(self.__PUBLICKEY.save_pkcs1("PEM"))
-        failed = True
-        while failed: #Attempt key exchange
+        self.__PUBLICKEY, self.__PRIVATEKEY = KEYS.Get() #Usually ready long before this point, as the keys are loaded while the game starts up
+        self.SOCK.sendall(frame(self.__PUBLICKEY.save_pkcs1("PEM")))
+        data = self.ReceiveFrame()
+        while data is None: #The server replies with the session key, encrypted with the public key
             for event in GAME.getevent():
                 pass
-            try:
-                data = self.regularSock.recv(2048)
-                self.__SERVERKEY = rsa.PublicKey.load_pkcs1(data, "PEM")
-            except Exception as e:
-                print(e)
-                continue
-            failed = False
+            data = self.ReceiveFrame()
+        self.regularCipher = SessionCipher(rsa.decrypt(data, self.__PRIVATEKEY), initiator=True) #Everything after the key exchange is encrypted with the session key rather than RSA
+        self.cipher = self.regularCipher #The cipher for whichever socket is currently in use
+        self.relay = False #Set while battle messages are being relayed through the server rather than sent directly to the enemy
         t.quit() #End loading screen thread
         t.join()
 
+    def ReceiveFrame(self) -> bytes or None:
+        "Returns the next whole frame received on the current socket, or None if one has not fully arrived yet"
+        data = self.buffer.pop()
+        if data is not None: #A frame may already be waiting if it arrived along with the last one
+            return data
+        try:
+            data = self.SOCK.recv(4096)
+        except s.error as e:
+            return None
+        try:
+            self.buffer.feed(data)
+        except FrameError as e:
+            print(e)
+        return self.buffer.pop()
+
     def Receive(self) -> dict:
         "Receive a decoded dictionary containing necessary arguments"
-        try: #Attempt to receive data. Return below dictionary if something goes wrong
-            data = self.SOCK.recv(2048)
-        except s.error as e:
+        data = self.ReceiveFrame() #Attempt to receive data. Return below dictionary if something goes wrong
+        if data is None:
             return {"Command": None, "Args": None}
         try:
-            data = rsa.decrypt(data, self.__PRIVATEKEY)
+            if self.relay: #Relayed messages arrive from the server wrapped in a RELAY message, with the enemies message still encrypted with the battle key inside
+                command, args = self.Decode(data, self.regularCipher)
+                if command != "RELAY":
+                    return {"Command": command, "Args": args}
+                data = args[0] if isinstance(args[0], bytes) else base64.b64decode(args[0])
+            command, args = self.Decode(data, self.cipher)
+        except UnauthorisedCodecError:
+            raise er.UnauthorisedMessageError #Check the authorisation code
         except Exception as e: #If a decryption problem occurs, return below dictionary
             print(e)
             return {"Command": None, "Args": None}
-        asString = data.decode("utf-8") #Decode and load the dictionary
-        dictionary = json.loads(asString)
-        print(f"{dictionary['Command']}", f"{dictionary['Args']} received")
-        if dictionary["AUTH"] != AUTH:
-            raise er.UnauthorisedMessageError #Check the authorisation code
-        return dictionary
+        print(f"{command}", f"{loggable(command, args)} received")
+        return {"Command": command, "Args": args}
+
+    def Decode(self, data: bytes, key: SessionCipher) -> tuple:
+        "Decrypts a message and decodes it with the codec agreed for the key. Returns the command and its arguments"
+        return (key.codec or JSONCODEC).decode(decryptMessage(data, key))
+
+    def Encrypt(self, command: str, key: SessionCipher, *args) -> bytes:
+        "Encodes and encrypts a command and its arguments"
+        print(command, loggable(command, args), "sent to", self.SOCK.getpeername())
+        return encryptMessage((key.codec or JSONCODEC).encode(command, args), key) #Encode with the codec agreed for the key and encrypt it
 
+    def Encode(self, command: str, key: SessionCipher, *args) -> bytes:
+        "Encodes and encrypts a command and its arguments into a frame ready to send"
+        return frame(self.Encrypt(command, key, *args))
 
     def Send(self, command: str, *args):
         "Takes a command and arguments and encodes and sends to server"
-        #Create dictionary and then load it into a string via json, encode it and send it
-        d = {"AUTH": AUTH, "Command": None, "Args": None}
-        d["Command"] = command
-        if args:
-            d["Args"] = args
-        message = json.dumps(d)
-        self.SOCK.send(rsa.encrypt(message.encode("utf-8"), self.__SERVERKEY))
-        print(d["Command"], d["Args"], "sent to", self.SOCK.getpeername())
+        self.SOCK.sendall(self.Encode(command, self.regularCipher, *args))
+
+    def SendMany(self, messages: 'list[tuple]'):
+        "Sends several commands to the server in one write. Each message is a tuple of the command followed by its arguments"
+        self.SOCK.sendall(b"".join(self.Encode(message[0], self.regularCipher, *message[1:]) for message in messages))
     
 
     def Login(self) -> bool:
@@ -1112,7 +1141,7 @@ class Connection:
             command = "SIGNUP" 
         else:
             command = "LOGIN"
-        self.Send(command, GAME.PLAYER.username, GAME.PLAYER.password) #Sends player data through
+        self.Send(command, GAME.PLAYER.username, GAME.PLAYER.password, BINARYCODEC.name) #Sends player data through, asking to use the binary codec once logged in
         command = self.Receive()["Command"] 
         while command == None: #Waits for command to come through
             for event in GAME.getevent():
@@ -1121,6 +1150,7 @@ class Connection:
         t.quit() #Exits loading screen
         t.join()
         if command == "LOGGEDIN": #Checks to see if the login was a success and returns a boolean based on this
+            self.regularCipher.codec = BINARYCODEC #The server switches to the binary codec straight after LOGGEDIN
             return True
         else:
             return False
@@ -1143,15 +1173,18 @@ class Connection:
         GAME.PLAYER.buffs.append(b)
         GAME.Save()
     
-    def SetBattleMode(self):
-        "Sets the socket to use port 11035, to deal with battle setup"
+    def SetBattleMode(self, token: str):
+        "Sets the socket to use port 11035, to deal with battle setup. The token from MATCHMADE tells the server which battle this connection is for"
         self.SOCK = s.socket(s.AF_INET, s.SOCK_STREAM) #Creates a new socket
+        self.buffer = FrameBuffer()
+        self.cipher = self.regularCipher #The setup data comes from the server, so uses the session key
         connected = False
         counter = 0
         while not connected: #Attempts to connect to the server
             try:
                 self.SOCK.connect((self.HOST, 11035))
                 self.SOCK.settimeout(1)
+                self.SOCK.sendall(frame(token.encode("utf-8")))
                 connected = True
             except Exception as e: #If the error is just a timeout, nothing happens, if not then after ten attempts
                                    #an error is raised
@@ -1167,16 +1200,27 @@ class Connection:
     
     def SetNormalMode(self): #Closes current socket and sets the main socket back to the regular 11034 port socket 
         "Return the connection back to its regular state"
-        try:
-            self.SOCK.close()
-        except:
-            pass
+        if self.SOCK is not self.regularSock: #In relay mode the regular socket is already in use
+            try:
+                self.SOCK.close()
+            except:
+                pass
         self.SOCK = self.regularSock
+        self.buffer = self.regularBuffer
+        self.cipher = self.regularCipher
+        self.relay = False
     
-    def SetBattlePlayerMode(self, enemyIP: str, first: bool):
-        "Sets up a peer to peer connection between a player and enemy. First represents which side will act as server"
+    def SetBattlePlayerMode(self, enemyIP: str, first: bool, cipher: SessionCipher):
+        "Sets up a peer to peer connection between a player and enemy. First represents which side will act as server, cipher is the battle key from the server. If enemyIP is None, the server relays the battle instead"
         self.SOCK.close()
+        self.cipher = cipher
+        if enemyIP is None: #The server relays messages between the players over their existing connections
+            self.SOCK = self.regularSock
+            self.buffer = self.regularBuffer
+            self.relay = True
+            return
         self.SOCK = s.socket(s.AF_INET, s.SOCK_STREAM)
+        self.buffer = FrameBuffer()
         if first:
             #If first, act as a server to accept the incoming connection and use the socket that spawns from that as the main one
             connected = False
@@ -1205,16 +1249,15 @@ class Connection:
                 for event in GAME.getevent():
                     pass
     
-    def SendToPlayer(self, command: str, key: rsa.PublicKey, *args): #The same as Send, but allows different keys
+    def SendToPlayer(self, command: str, key: SessionCipher, *args): #The same as Send, but allows different keys
         "Takes a command and arguments and encodes and sends to player. Allows for key specification"
-        d = {"AUTH": AUTH, "Command": None, "Args": None}
-        d["Command"] = command
-        if args:
-            d["Args"] = args
-        message = json.dumps(d)
-        data = rsa.encrypt(message.encode("utf-8"), key)
-        self.SOCK.send(data)
-        print(d["Command"], d["Args"], "sent to", self.SOCK.getpeername())
+        if self.relay: #Wrap the message for the server to pass on. It stays encrypted with the battle key, so the server only forwards it
+            message = self.Encrypt(command, key, *args)
+            if not (self.regularCipher.codec or JSONCODEC).binary: #Json cannot carry raw bytes
+                message = base64.b64encode(message).decode("ascii")
+            self.SOCK.sendall(self.Encode("RELAY", self.regularCipher, message))
+            return
+        self.SOCK.sendall(self.Encode(command, key, *args))
 
 ##################################################################################
 
@@ -1232,7 +1275,7 @@ class Player:
         self.ip = ip
         self.prioritycountries = [] #type: list[Country]
         self.prioritybuffs = [] #type: list[Buff]
-        self.key = key #type: rsa.PublicKey
+        self.key = key #type: SessionCipher
     
     def Text(self) -> str:
         "Returns a string in the form USERNAME - Elo: ELO"
@@ -1257,11 +1300,12 @@ class Player:
             return
         priority.append(card) #If not, adds the card to the list, and sets the priority flag on the card
         card.priority = True
-        CONN.Send("PRIORITY"+cardtype, hash(card)) #Sends a request to prioritise the card
+        messages = [("PRIORITY"+cardtype, hash(card))] #Requests to prioritise the card
         while len(priority) > 2: #Makes sure the list is only of length 2, deprioritises the first item in the lists
             old = priority.pop(0)
             old.priority = False
-            CONN.Send("DEPRIORITISE"+cardtype, hash(old))
+            messages.append(("DEPRIORITISE"+cardtype, hash(old)))
+        CONN.SendMany(messages) #Sends every change together
     
     def ChangeElo(self, newElo: int):
         self.elo = newElo
@@ -1579,6 +1623,8 @@ class Battle:
         GAME.MusicPlayer.unload() #Unloads previous music and loads up the battle theme
         GAME.MusicPlayer.load(resource_path("music/Battle.ogg"))
         self.PlayerActions = [[[hash(self.countries[0]), None], [], None], [[hash(self.countries[1]), None], [], None]] #Creates the template for how actions are stored per turn
+        self.turn = 0 #Number of the turn being exchanged with the enemy, sent with each set of actions
+        self.matchedAt = None #When the match was found, if this battle was matchmade
     
     def Run(self):
         "Begin the battle game loop"
@@ -1627,6 +1673,9 @@ class Battle:
                     
 
             GAME.Update() #Update the game
+            if self.matchedAt is not None: #Report the time from the match being found to the first frame of the battle
+                print(f"Battle setup took {time() - self.matchedAt:.3f}s from match found to first frame")
+                self.matchedAt = None
 
         for card in self.playerCountries: #Resets players cards
             card.Reset()
@@ -1651,36 +1700,20 @@ class Battle:
             pos = (GAME.SCREENWIDTH-130, 220+270*i)
             self.enemyBuffs[i].UpdatePosition(pos)
 
-    def ReceiveEnemyActions(self) -> list:
-        CONN.SendToPlayer("READYTORECEIVE", self.enemy.key) #Tells the enemy the player is ready to receive the actions
-        data = CONN.Receive()
-        while data["Command"] != "CHANGES": #Receives the first set of changes
-            for event in GAME.getevent():
-                pass
+    def ReceiveEnemyActions(self) -> list or bool:
+        "Waits for the enemies actions for this turn. Returns True if the enemy resigned instead"
+        while True:
             data = CONN.Receive()
-        CONN.SendToPlayer("RECEIVED", self.enemy.key) #Sends back a message saying this has been received, acting as a clear-to-send
-        data2 = CONN.Receive()
-        while data2["Command"] != "CHANGES": #Receives next set of changes
+            if data["Command"] == "RESIGN":
+                return True
+            if data["Command"] == "TURN" and data["Args"][0] == self.turn: #Anything from an earlier turn is stale and ignored, so the turns cannot get out of step
+                return data["Args"][1]
             for event in GAME.getevent():
                 pass
-            data2 = CONN.Receive()
-        CONN.SendToPlayer("RECEIVED", self.enemy.key) #Sends back a message saying this has been received, acting as a clear-to-send
-        temp = [data["Args"][0], data2["Args"][0]] #Combines the actions into a single iterable
-        return temp
 
-    def SendPlayerActions(self): 
-        CONN.SendToPlayer("CHANGES", self.enemy.key, self.PlayerActions[0]) #Sends first set of changes and waits for confirmation
-        data = CONN.Receive()
-        while data["Command"] != "RECEIVED":
-            for event in GAME.getevent():
-                pass
-            data = CONN.Receive()
-        CONN.SendToPlayer("CHANGES", self.enemy.key, self.PlayerActions[1]) #Sends second set of changes and waits for confirmation
-        data = CONN.Receive()
-        while data["Command"] != "RECEIVED":
-            for event in GAME.getevent():
-                pass
-            data = CONN.Receive()
+    def SendPlayerActions(self):
+        "Sends both countries actions for this turn in a single message"
+        CONN.SendToPlayer("TURN", self.enemy.key, self.turn, self.PlayerActions)
 
     def GetEnemyActions(self) -> list:
         "Get the enemy players choices and send off your own"
@@ -1691,42 +1724,15 @@ class Battle:
             else:
                 self.PlayerActions[i][2] = hash(self.playerCountries[i].Buff)
             self.PlayerActions[i][1] = self.playerCountries[i].UnitsBought
-        if self.playerFirst: #If you are the first player, wait for the ready signal then respond with your own 
-            data = CONN.Receive() #If you arent the first player send a message saying you are ready to send changes and wait for the enemy to also be ready
-            while data["Command"] != "READY" and data["Command"] != "RESIGN": 
-                for event in GAME.getevent():
-                    pass
-                data = CONN.Receive()
-            CONN.SendToPlayer("READY", self.enemy.key) 
-        else:
-            CONN.SendToPlayer("READY", self.enemy.key)
-            data = CONN.Receive()
-            while data["Command"] != "READY" and data["Command"] != "RESIGN": #Checks if the enemy has resigned or is ready to swap actions
-                for event in GAME.getevent():
-                    pass
-                data = CONN.Receive()
-        
-        if data["Command"] == "RESIGN": #If the enemy has resigned, end the loading screen and win the battle
+        self.turn += 1
+        #Both players send their actions straight away and then wait for the enemies, so a turn takes one trip across the connection whoever goes first
+        self.SendPlayerActions()
+        data = self.ReceiveEnemyActions()
+        if data is True: #If the enemy has resigned, end the loading screen and win the battle
             t.quit()
             t.join()
             self.BattleFinished(True)
             return True
-
-        if self.playerFirst: #If you are the first player, wait for the opponent to be ready to receive and then call the SendPlayerActions function
-            data = CONN.Receive()
-            while data["Command"] != "READYTORECEIVE":
-                for event in GAME.getevent():
-                    pass
-            self.SendPlayerActions()
-            data = self.ReceiveEnemyActions()
-        else: #If not, call the receive actions function and then wait for confirmation to send and call the send actions function
-            data = self.ReceiveEnemyActions()
-            data2 = CONN.Receive()
-            while data2["Command"] != "READYTORECEIVE":
-                for event in GAME.getevent():
-                    pass
-                data2 = CONN.Receive()
-            self.SendPlayerActions()
         self.PlayerActions = [[[hash(self.countries[0]), None], [], None], [[hash(self.countries[1]), None], [], None]] #Reset the template for user actions
         t.quit()
         t.join() #End the loading screen
@@ -1812,7 +1818,6 @@ class Battle:
                 card = PlayerDefensiveCountry(production, towns, name)
         elif data["Args"][0] == "BUFF":
             card = eval(data["Args"][1]+"Buff(True)")
-        CONN.Send("RECEIVED") #Send confirmation that it has been received
         return card
 
 class TutorialBattle(Battle):
@@ -2692,6 +2697,36 @@ class InputBox:
 
 ####################################################################################################
 
+class KeyLoader(threading.Thread):
+    "Loads the client keypair from COC.key in the background, generating and saving a new one if it does not exist yet"
+    def __init__(self):
+        super(KeyLoader, self).__init__(daemon=True)
+        self.keys = None #type: tuple[rsa.PublicKey, rsa.PrivateKey]
+        self.start()
+
+    def run(self):
+        keyPath = path.abspath(path.dirname(sys.argv[0])) + "/COC.key" #Kept next to the save file
+        try:
+            with open(keyPath, "rb") as f:
+                privateKey = rsa.PrivateKey.load_pkcs1(f.read(), "PEM")
+            self.keys = (rsa.PublicKey(privateKey.n, privateKey.e), privateKey)
+            return
+        except Exception as e: #If it doesnt exist or has been corrupted, generate a new keypair
+            print(e)
+        self.keys = rsa.newkeys(2048)
+        try:
+            saveKeyFile(keyPath, self.keys[1].save_pkcs1("PEM")) #Only readable by the player, and never left half written if the game is closed while saving
+        except OSError as e: #The keys can still be used for this launch even if they cannot be saved
+            print(e)
+
+    def Get(self) -> tuple:
+        "Returns the keypair, waiting for it to be loaded if necessary. Game events are still processed while waiting"
+        while self.is_alive():
+            for event in GAME.getevent():
+                pass
+            self.join(0.05)
+        return self.keys
+
 class Thread(threading.Thread):
     "Custom thread to allow for quitting from within functions containing a while loop"
     def __init__(self, target: 'function', args: list):
@@ -3095,7 +3130,8 @@ def Play():
                 t.join()
                 return
         data = CONN.Receive()
-    CONN.SetBattleMode() #Set the connection to receive setup information from the server
+    matchedAt = time() #Used to report how long the battle took to set up
+    CONN.SetBattleMode(data["Args"][0]) #Set the connection to receive setup information from the server
     t.quit()
     t.join()
     t = Thread(target=LoadScreen, args=["Initialising Battle..."]) #generate a new loading screen
@@ -3104,88 +3140,19 @@ def Play():
         for event in GAME.getevent():
             pass
         setupdata = CONN.Receive()
-    CONN.Send("RECEIVED") #Send received message
-    received = False
-    while not received:
-        try: #Wait to receive the enemies public key
-            key = CONN.SOCK.recv(2048)
-            received = True
-        except Exception as e:
-            print(e)
-        for event in GAME.getevent():
-            pass
-    try:
-        key = rsa.PublicKey.load_pkcs1(key, "PEM") #Load the public key
-    except Exception as e:
-        print(e)
+    key = SessionCipher(bytes.fromhex(setupdata["Args"][2]), initiator=not setupdata["Args"][1]) #Both players are given the same battle key, which encrypts everything sent between them. The player going second initiates, so each direction gets its own key
+    if setupdata["Args"][3] == BINARYCODEC.name: #The server only chooses the binary codec if both players are using it
+        key.codec = BINARYCODEC
     d3["First"] = setupdata["Args"][1] #Gets whether the player goes first or not and creates the player object
     enemy = Player(ip=setupdata["Args"][0], key=key)
-    CONN.SetBattlePlayerMode(setupdata["Args"][0], setupdata["Args"][1]) #sets up the peer to peer connection
-    if d3["First"]: #If the player goes first
-        data = CONN.Receive()
-        while data["Command"] != "CLEAR": #Waits for the clear to send then sends the battle setup data
-            for event in GAME.getevent():
-                pass
-            data = CONN.Receive()
-        CONN.SendToPlayer("BATTLE", enemy.key, d1)
-        data = CONN.Receive()
-        while data["Command"] != "RECEIVED":
-            for event in GAME.getevent():
-                pass
-            data = CONN.Receive()
-        CONN.SendToPlayer("BATTLE", enemy.key, d2)
-        data = CONN.Receive()
-        while data["Command"] != "RECEIVED":
-            for event in GAME.getevent():
-                pass
-            data = CONN.Receive()
-        CONN.SendToPlayer("BATTLE", enemy.key, d3)
-        data = CONN.Receive()
-        while data["Command"] != "RECEIVED":
-            for event in GAME.getevent():
-                pass
-            data = CONN.Receive()
-    CONN.SendToPlayer("CLEAR", enemy.key) #Sends the clear to send, then receives enemy data
+    CONN.SetBattlePlayerMode(setupdata["Args"][0], setupdata["Args"][1], key) #sets up the peer to peer connection
+    CONN.SendToPlayer("SETUP", enemy.key, d1, d2, d3) #Both players send their whole loadout at once, then wait for the enemies
     data = CONN.Receive()
-    while data["Command"] != "BATTLE": #Expects Dict containing key "EnemyCountries"
-        for event in GAME.getevent():
-            pass
-        data = CONN.Receive()
-    battle = data["Args"][0]
-    CONN.SendToPlayer("RECEIVED", enemy.key)
-    data2 = CONN.Receive() 
-    while data2["Command"] != "BATTLE": #Expects Dict containing key "EnemyBuffs"
-        for event in GAME.getevent():
-            pass
-        data2 = CONN.Receive()
-    battle2 = data2["Args"][0]
-    CONN.SendToPlayer("RECEIVED", enemy.key)
-    data3 = CONN.Receive() 
-    while data3["Command"] != "BATTLE": #Expects Dict containing key "EnemyBuffs"
+    while data["Command"] != "SETUP": #Expects the enemies countries, buffs and player information
         for event in GAME.getevent():
             pass
-        data3 = CONN.Receive()
-    battle3 = data3["Args"][0]
-    CONN.SendToPlayer("RECEIVED", enemy.key)
-    if not d3["First"]: #If the player does not go first, send changes
-        CONN.SendToPlayer("BATTLE", enemy.key, d1)
-        data = CONN.Receive()
-        while data["Command"] != "RECEIVED":
-            for event in GAME.getevent():
-                pass
-            data = CONN.Receive()
-        CONN.SendToPlayer("BATTLE", enemy.key, d2)
-        data = CONN.Receive()
-        while data["Command"] != "RECEIVED":
-            for event in GAME.getevent():
-                pass
-            data = CONN.Receive()
-        CONN.SendToPlayer("BATTLE", enemy.key, d3)
         data = CONN.Receive()
-        while data["Command"] != "RECEIVED":
-            for event in GAME.getevent():
-                pass
-            data = CONN.Receive()
+    battle, battle2, battle3 = data["Args"]
     enemyCountries = battle #Create country objects and instantiate the battle
     enemyBuffs = battle2
     enemyCountryObjects = []
@@ -3206,6 +3173,7 @@ def Play():
     for buff in enemyBuffs:
         enemyBuffObjects.append(eval(buff + "(False)"))
     battle = Battle(GAME.PLAYER, playerCountries, playerBuffs, enemy, enemyCountryObjects, enemyBuffObjects, battle3["First"])
+    battle.matchedAt = matchedAt
     t.quit()
     t.join() #End the loading screen
     battle.Run() #begin the battle
@@ -3263,7 +3231,8 @@ def LoadScreen(string: str, thread: Thread):
         GAME.Update()
 
 def Main():
-    global GAME #Initialise the game
+    global GAME, KEYS #Initialise the game
+    KEYS = KeyLoader() #Starts loading the keys straight away, so they are ready by the time the connection is made
     GAME = Game()
     GAME.LoadPlayer() #Load player data
     MainLoop() #Calls main loop
@@ -21,3 +21,9 @@ class DatabaseAccessError(DatabaseError):
     def __init__(self):
 
         super(DatabaseAccessError, self).__init__("Database cannot be accessed!")
+
+class DatabaseMigrationError(DatabaseError):
+
+    def __init__(self, version: int, reason: str):
+
+        super(DatabaseMigrationError, self).__init__(f"Migration to schema version {version} failed: {reason}")
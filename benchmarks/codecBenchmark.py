@@ -0,0 +1,54 @@
+#Compares the json and binary codecs on messages typical of a session and a battle: the bytes sent, and the time to encode and decode each one,
+#with and without the session cipher. Run from the repository root with: python benchmarks/codecBenchmark.py
+import sys
+import timeit
+from os import path
+from hashlib import sha256
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from codec import JsonCodec, BinaryCodec
+from protocol import SessionCipher
+
+AUTH = str(sha256("121212".encode("ascii"), usedforsecurity=True).digest())
+
+MESSAGES = {
+    "MATCHMAKE": ("MATCHMAKE", ()),
+    "PRIORITYCOUNTRY": ("PRIORITYCOUNTRY", (2914391735,)),
+    "ELO": ("ELO", (1016,)),
+    "MATCHMADE": ("MATCHMADE", ("9f2c1e7a5b3d4f6081726354a9b8c7d6",)),
+    "REWARD": ("REWARD", ("COUNTRY", "Trinidad & Tobago", 40, "BAL", 25)),
+    "SETUP": ("SETUP", ([["Angola", 40, "BAL", 25], ["Canada", 40, "AGG", 25]], ["MajorAttackBuff", "MinorTownsBuff"], {"Player": ["player1", 1000], "First": True})),
+    "TURN": ("TURN", (3, [[[3141592653, 2718281828], ["Infantry", "Tank", "Plane"], 1618033988], [[1414213562, None], ["Fortification"], None]])),
+}
+
+def measure(statement: str, number: int) -> float:
+    "Returns the best time per call in microseconds"
+    return min(timeit.repeat(statement, number=number, repeat=5, globals=globals())) / number * 1e6
+
+def main(number=20000):
+    global codec, cipher, receiver, command, args, encoded, sealed
+    codecs = {"json": JsonCodec(AUTH), "binary": BinaryCodec()}
+    cipher = SessionCipher.generate(initiator=True)
+    receiver = SessionCipher(cipher.key, initiator=False) #Each direction has its own key, so messages are decrypted by the other end
+    print(f"{'message':<16}{'codec':<8}{'bytes':>7}{'encode us':>11}{'decode us':>11}{'+cipher us':>12}")
+    totals = {name: [0, 0.0, 0.0, 0.0] for name in codecs}
+    for label, (command, args) in MESSAGES.items():
+        for name, codec in codecs.items():
+            encoded = codec.encode(command, args)
+            sealed = cipher.encrypt(encoded)
+            assert codec.decode(encoded)[0] == command
+            encodeTime = measure("codec.encode(command, args)", number)
+            decodeTime = measure("codec.decode(encoded)", number)
+            roundTrip = measure("codec.decode(receiver.decrypt(cipher.encrypt(codec.encode(command, args))))", number) #The whole cost of sending and receiving the message
+            print(f"{label:<16}{name:<8}{len(encoded):>7}{encodeTime:>11.2f}{decodeTime:>11.2f}{roundTrip:>12.2f}")
+            total = totals[name]
+            total[0] += len(encoded)
+            total[1] += encodeTime
+            total[2] += decodeTime
+            total[3] += roundTrip
+    print()
+    for name, (size, encodeTime, decodeTime, roundTrip) in totals.items():
+        print(f"{'all':<16}{name:<8}{size:>7}{encodeTime:>11.2f}{decodeTime:>11.2f}{roundTrip:>12.2f}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
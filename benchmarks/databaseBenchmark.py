@@ -0,0 +1,79 @@
+#Builds a database of the original schema with many players, then times the queries the server runs most before and after the migrations are applied.
+#Run from the repository root with: python benchmarks/databaseBenchmark.py [players]
+import sys
+import random
+import sqlite3
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from migrations import createTables, migrate
+
+QUERIES = { #The queries run at login, on a priority change and on a reward
+    "load countries": "SELECT name, production, towns, type, priority FROM Country WHERE playerID = ?;",
+    "load buffs": "SELECT type, priority FROM Buff WHERE playerID = ?;",
+    "priority update": "UPDATE Country SET priority = 1 WHERE hash = ? AND playerID = ?;",
+    "reward insert": "INSERT INTO Buff (type, priority, hash, playerID) VALUES ('MinorTowns', 0, ?, ?) ON CONFLICT (playerID, hash) DO NOTHING;",
+}
+ORIGINAL = { #ON CONFLICT needs the unique index added by the migrations, so before them a reward is saved the way the original server did, reading every hash the player owns first
+    "reward insert": ("SELECT hash FROM Buff WHERE playerID = ?;", "INSERT INTO Buff (type, priority, hash, playerID) VALUES ('MinorTowns', 0, ?, ?);"),
+}
+
+def build(filename: str, players: int, cardsEach: int):
+    "Fills a database with the original, unindexed schema"
+    conn = sqlite3.connect(filename)
+    createTables(conn)
+    rng = random.Random(1)
+    conn.executemany("INSERT INTO Player VALUES (?, 'password', 0, 0, 1000);", ((f"player{i}",) for i in range(players)))
+    conn.executemany("INSERT INTO Country (name, playerID, towns, type, production, priority, hash) VALUES ('Angola', ?, 40, 'BAL', 25, ?, ?);",
+                     ((f"player{i}", int(c < 2), rng.getrandbits(32)) for i in range(players) for c in range(cardsEach)))
+    conn.executemany("INSERT INTO Buff (type, playerID, priority, hash) VALUES ('MinorTowns', ?, ?, ?);",
+                     ((f"player{i}", int(c < 2), rng.getrandbits(32)) for i in range(players) for c in range(cardsEach)))
+    conn.commit()
+    conn.close()
+
+def measure(filename: str, players: int, number: int, migrated: bool) -> dict:
+    "Returns the mean time of each query in milliseconds, against random players"
+    conn = sqlite3.connect(filename)
+    rng = random.Random(2)
+    results = {}
+    for label, query in QUERIES.items():
+        started = time.perf_counter()
+        for i in range(number):
+            username = f"player{rng.randrange(players)}"
+            if label == "priority update":
+                conn.execute(query, (rng.getrandbits(32), username))
+            elif label == "reward insert":
+                if migrated:
+                    conn.execute(query, (rng.getrandbits(32), username))
+                else:
+                    select, insert = ORIGINAL[label]
+                    owned = {row[0] for row in conn.execute(select, (username,))}
+                    cardHash = rng.getrandbits(32)
+                    if cardHash not in owned:
+                        conn.execute(insert, (cardHash, username))
+            else:
+                conn.execute(query, (username,)).fetchall()
+        results[label] = (time.perf_counter() - started) / number * 1000
+    conn.rollback()
+    conn.close()
+    return results
+
+def main(players=100000, cardsEach=5):
+    with tempfile.TemporaryDirectory() as directory: #Removed with the database and its WAL files even if the benchmark fails
+        filename = path.join(directory, "benchmark.sqlite3")
+        started = time.perf_counter()
+        build(filename, players, cardsEach)
+        print(f"Built {players} players with {cardsEach} countries and {cardsEach} buffs each in {time.perf_counter() - started:.1f}s")
+        before = measure(filename, players, 50, False)
+        started = time.perf_counter()
+        migrate(filename)
+        print(f"Migrated in {time.perf_counter() - started:.1f}s")
+        after = measure(filename, players, 5000, True)
+    print(f"{'query':<18}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for label in QUERIES:
+        print(f"{label:<18}{before[label]:>12.3f}{after[label]:>12.4f}{before[label] / after[label]:>9.0f}x")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,288 @@
+#Opens many headless sessions against a running server.py, each following the same protocol as the game without pygame: key exchange, SIGNUP,
+#priority changes, MATCHMAKE, battle setup through the rendezvous on port 11035, GETREWARDWIN/GETREWARDLOSS and END, then a second connection
+#to LOGIN. The sessions are run in steps of increasing size, reporting throughput, latency of each step and the server's memory and threads.
+#With --relay, each matched pair also plays out a battle of TURN messages relayed through the server, which must be started with --relay too.
+#Start the server, then run from the repository root with, for example: python benchmarks/loadTest.py --sessions 10 50 100 200
+import sys
+import os
+import socket
+import random
+import argparse
+import base64
+import threading
+import time
+from hashlib import sha256
+from os import path
+
+import rsa
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from protocol import frame, FrameBuffer, SessionCipher, encryptMessage, decryptMessage
+from codec import JsonCodec, BinaryCodec
+
+AUTH = str(sha256("121212".encode("ascii"), usedforsecurity=True).digest())
+JSONCODEC = JsonCodec(AUTH)
+BINARYCODEC = BinaryCodec()
+
+class BotError(Exception):
+
+    def __init__(self, message: str):
+
+        super(BotError, self).__init__("Bot Error: " + message)
+
+class Bot: #A single headless player session
+    def __init__(self, host: str, keys: tuple, codec: str, timeout: float, turns=0):
+        self.host = host
+        self.publicKey, self.privateKey = keys
+        self.codec = codec
+        self.timeout = timeout #Seconds to wait for any reply, including a match
+        self.turns = turns #TURN messages each player sends their enemy through the relay, or 0 to skip the battle
+        self.latencies = {} #type: dict[str, float] #Seconds taken by each step
+        self.roundTrips = [] #type: list[float] #Seconds from sending each TURN until the enemy's reply arrived, for the player going first
+
+    def connect(self, port: int) -> tuple[socket.socket, FrameBuffer]:
+        sock = socket.create_connection((self.host, port), timeout=self.timeout)
+        return sock, FrameBuffer()
+
+    def receiveFrame(self, sock: socket.socket, buffer: FrameBuffer) -> bytes:
+        while not len(buffer):
+            data = sock.recv(65536)
+            if not data:
+                raise BotError("Connection closed by the server")
+            buffer.feed(data)
+        return buffer.pop()
+
+    def send(self, command: str, *args):
+        codec = self.cipher.codec or JSONCODEC
+        self.sock.sendall(frame(encryptMessage(codec.encode(command, args), self.cipher)))
+
+    def receive(self, sock=None, buffer=None) -> tuple[str, list]:
+        data = self.receiveFrame(sock or self.sock, buffer or self.buffer)
+        return (self.cipher.codec or JSONCODEC).decode(decryptMessage(data, self.cipher))
+
+    def expect(self, command: str, sock=None, buffer=None) -> list:
+        received, args = self.receive(sock, buffer)
+        if received != command:
+            raise BotError(f"Expected {command}, received {received} {args}")
+        return args
+
+    def timed(self, step: str, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        self.latencies[step] = time.perf_counter() - started
+        return result
+
+    def open(self, step: str): #Connects and exchanges keys, as Connection does in the game
+        def exchange():
+            self.sock, self.buffer = self.connect(11034)
+            self.sock.sendall(frame(self.publicKey.save_pkcs1("PEM")))
+            self.cipher = SessionCipher(rsa.decrypt(self.receiveFrame(self.sock, self.buffer), self.privateKey), initiator=True)
+        self.timed(step, exchange)
+        self.expect("LOGIN")
+
+    def login(self, command: str, username: str, password: str):
+        def login():
+            self.send(command, username, password, self.codec)
+            self.expect("LOGGEDIN")
+        self.timed(command, login)
+        if self.codec == BINARYCODEC.name:
+            self.cipher.codec = BINARYCODEC
+
+    def run(self, username: str):
+        password = sha256(f"{username}password".encode("utf-8")).hexdigest()
+        self.open("keyExchange")
+        self.login("SIGNUP", username, password)
+        for i in range(4): #Reshuffles the starting loadout, as a player in the inventory would. Nothing is sent back
+            self.send(random.choice(("DEPRIORITISECOUNTRY", "PRIORITYCOUNTRY", "DEPRIORITISEBUFF", "PRIORITYBUFF")), random.getrandbits(32))
+        token = self.timed("MATCHMAKE", self.__matchmake)
+        enemyIP, first, battleKey, battleCodec = self.timed("setup", self.__setup, token)
+        if self.turns:
+            if enemyIP is not None:
+                raise BotError("The server is not relaying battles. Start it with --relay")
+            self.timed("battle", self.__battle, battleKey, first, battleCodec)
+        def reward():
+            self.send("GETREWARDWIN" if first else "GETREWARDLOSS")
+            self.expect("REWARD")
+            self.expect("ELO")
+        self.timed("GETREWARD", reward)
+        self.send("END")
+        self.sock.close()
+        self.open("reconnect")
+        self.login("LOGIN", username, password)
+        self.send("END")
+        self.sock.close()
+
+    def __matchmake(self) -> str:
+        self.send("MATCHMAKE")
+        return self.expect("MATCHMADE")[0]
+
+    def __setup(self, token: str) -> list: #Presents the token to the rendezvous and reads the battle details: the enemy's address, whether this bot goes first, the battle key and codec
+        sock, buffer = self.connect(11035)
+        try:
+            sock.sendall(frame(token.encode("utf-8")))
+            return self.expect("IP", sock, buffer)[:4]
+        finally:
+            sock.close()
+
+    def __battle(self, battleKey: str, first: bool, battleCodec: str): #Takes turns with the enemy through the relay, as Battle does in the game. The player going first times each exchange
+        cipher = SessionCipher(bytes.fromhex(battleKey), initiator=not first)
+        if battleCodec == BINARYCODEC.name:
+            cipher.codec = BINARYCODEC
+        actions = [[[random.getrandbits(32), random.getrandbits(32)], ["Infantry", "Tank", "Plane"], random.getrandbits(32)], [[random.getrandbits(32), None], ["Fortification"], None]]
+        for turn in range(self.turns):
+            if first:
+                started = time.perf_counter()
+                self.sendRelay(cipher, "TURN", turn, actions)
+                self.expectTurn(cipher, turn)
+                self.roundTrips.append(time.perf_counter() - started)
+            else:
+                self.expectTurn(cipher, turn)
+                self.sendRelay(cipher, "TURN", turn, actions)
+
+    def sendRelay(self, cipher: SessionCipher, command: str, *args): #Wraps a battle message for the server to pass on, as Connection.SendToPlayer does
+        message = encryptMessage((cipher.codec or JSONCODEC).encode(command, args), cipher)
+        if not (self.cipher.codec or JSONCODEC).binary: #Json cannot carry raw bytes
+            message = base64.b64encode(message).decode("ascii")
+        self.send("RELAY", message)
+
+    def expectTurn(self, cipher: SessionCipher, turn: int):
+        message = self.expect("RELAY")[0]
+        if not isinstance(message, bytes):
+            message = base64.b64decode(message)
+        command, args = (cipher.codec or JSONCODEC).decode(decryptMessage(message, cipher))
+        if command != "TURN" or args[0] != turn:
+            raise BotError(f"Expected TURN {turn} from the enemy, received {command} {args}")
+
+class ServerMonitor(threading.Thread): #Samples the server's memory and thread count from /proc while a step runs
+    def __init__(self, pid: int or None, interval=0.2):
+        super(ServerMonitor, self).__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.peakRSS = 0 #Kilobytes
+        self.peakThreads = 0
+
+    def sample(self) -> tuple[int, int]:
+        "Current resident memory in kilobytes and number of threads, or zeros if the server cannot be read"
+        if self.pid is None:
+            return 0, 0
+        rss = threads = 0
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss = int(line.split()[1])
+                    elif line.startswith("Threads:"):
+                        threads = int(line.split()[1])
+        except OSError:
+            pass
+        return rss, threads
+
+    def run(self):
+        while not self.stopping.is_set():
+            rss, threads = self.sample()
+            self.peakRSS = max(self.peakRSS, rss)
+            self.peakThreads = max(self.peakThreads, threads)
+            self.stopping.wait(self.interval)
+
+def isPythonServer(pid: int) -> bool:
+    "Whether a process is a python interpreter running server.py, rather than a wrapper such as timeout or a shell that only mentions it"
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            arguments = [argument.decode("utf-8", "replace") for argument in f.read().split(b"\0") if argument]
+    except OSError:
+        return False
+    try:
+        interpreter = os.readlink(f"/proc/{pid}/exe")
+    except OSError: #Another user's process, so fall back to the name it was started with
+        interpreter = arguments[0] if arguments else ""
+    if not path.basename(interpreter).startswith(("python", "pypy")):
+        return False
+    script = next((argument for argument in arguments[1:] if not argument.startswith("-")), "") #The first argument after the interpreter's own options
+    return path.basename(script) == "server.py"
+
+def findServer() -> int or None:
+    "The pid of the running server.py, found from /proc. None if there is not exactly one, as the wrong process would be measured"
+    try:
+        pids = [int(entry) for entry in os.listdir("/proc") if entry.isdigit()]
+    except OSError:
+        return None
+    servers = [pid for pid in pids if pid != os.getpid() and isPythonServer(pid)]
+    if len(servers) > 1:
+        print(f"Found several servers running ({', '.join(map(str, servers))}). Pass --pid to choose which one to measure")
+        return None
+    return servers[0] if servers else None
+
+def percentile(values: list, p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+def step(sessions: int, options, keys: tuple, pid: int or None) -> dict:
+    "Runs a number of bots at once and collects their results"
+    codecs = ["binary", "json"] if options.codec == "mixed" else [options.codec] #Mixed alternates the bots between codecs, so some battles are relayed between players on different codecs
+    bots = [Bot(options.host, keys, codecs[i % len(codecs)], options.timeout, options.relay) for i in range(sessions)]
+    errors = {}
+    errorsLock = threading.Lock()
+    prefix = f"b{random.randrange(36 ** 4):04x}" #Keeps usernames unique across runs, and short enough for the Player table
+    def run(i: int):
+        try:
+            bots[i].run(f"{prefix}{i}")
+        except Exception as error:
+            with errorsLock:
+                errors[type(error).__name__] = errors.get(type(error).__name__, 0) + 1
+    monitor = ServerMonitor(pid)
+    before = monitor.sample()
+    monitor.start()
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(sessions)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    monitor.stopping.set()
+    monitor.join()
+    latencies = {}
+    for bot in bots:
+        for name, seconds in bot.latencies.items():
+            latencies.setdefault(name, []).append(seconds)
+        if bot.roundTrips:
+            latencies.setdefault("relay turn", []).extend(bot.roundTrips)
+    for values in latencies.values():
+        values.sort()
+    logins = len(latencies.get("SIGNUP", [])) + len(latencies.get("LOGIN", []))
+    relayed = len(latencies.get("relay turn", [])) * 2 #Each timed exchange is a TURN relayed each way
+    return {"sessions": sessions, "completed": len(latencies.get("LOGIN", [])), "errors": errors, "wall": wall, "loginsPerSecond": logins / wall,
+            "relayed": relayed, "relayedPerSecond": relayed / latencies["battle"][-1] if relayed else 0, #The battles run at the same time, so this is over the longest of them
+            "latencies": latencies, "rssBefore": before[0], "rssPeak": monitor.peakRSS, "threadsBefore": before[1], "threadsPeak": monitor.peakThreads}
+
+def report(result: dict):
+    print(f"\n{result['sessions']} sessions: {result['completed']} completed in {result['wall']:.2f}s, {result['loginsPerSecond']:.1f} logins/s"
+          + (f", {result['relayed']} messages relayed at {result['relayedPerSecond']:.0f}/s" if result["relayed"] else "")
+          + (f", errors {result['errors']}" if result["errors"] else ""))
+    if result["rssPeak"]:
+        print(f"  server RSS {result['rssBefore'] / 1024:.1f}MB -> peak {result['rssPeak'] / 1024:.1f}MB, threads {result['threadsBefore']} -> peak {result['threadsPeak']}")
+    print(f"  {'step':<14}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name in ("keyExchange", "SIGNUP", "MATCHMAKE", "setup", "relay turn", "battle", "GETREWARD", "reconnect", "LOGIN"):
+        values = result["latencies"].get(name, [])
+        if values:
+            print(f"  {name:<14}{len(values):>7}" + "".join(f"{percentile(values, p) * 1000:>10.1f}" for p in (0.5, 0.9, 0.99)) + f"{values[-1] * 1000:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests a running server with headless bot sessions")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10, 50, 100], help="concurrent sessions in each step. Use even numbers so every bot gets matched")
+    parser.add_argument("--host", default=socket.gethostbyname(socket.gethostname()), help="address the server is bound to")
+    parser.add_argument("--codec", default="binary", choices=["binary", "json", "mixed"])
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for any reply")
+    parser.add_argument("--pid", type=int, help="server process to measure. Found automatically if exactly one python server.py is running on this machine")
+    parser.add_argument("--pause", type=float, default=2, help="seconds between steps, so the server can finish writing")
+    parser.add_argument("--relay", type=int, default=0, metavar="TURNS", help="TURN messages each pair exchanges through the server before reporting the result. The server must be started with --relay")
+    options = parser.parse_args()
+    pid = options.pid or findServer()
+    print(f"Generating the bot keypair..." + ("" if pid else " (server process not found, so memory and threads will not be reported)"))
+    keys = rsa.newkeys(1024) #Shared by every bot, as generating one each would take longer than the test. Large enough to carry the session key
+    for sessions in options.sessions:
+        report(step(sessions, options, keys, pid))
+        time.sleep(options.pause)
+
+if __name__ == "__main__":
+    main()
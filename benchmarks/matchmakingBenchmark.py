@@ -0,0 +1,76 @@
+#Times the operations on a matchmaking pool with many players already queued: the original sorted list, rebuilt by slicing on every insert,
+#against the EloQueue skip list. Run from the repository root with: python benchmarks/matchmakingBenchmark.py [queued] [operations]
+import sys
+import random
+import time
+from bisect import bisect_right
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from matchmaking import EloQueue
+
+class QueuedPlayer:
+    __slots__ = ("elo",)
+
+    def __init__(self, elo: int):
+        self.elo = elo
+
+class ListPool: #The original pool: a binary search for the position, then the list rebuilt around the new player, and list.remove to leave
+    def __init__(self):
+        self.pool = []
+        self.elos = [] #Kept alongside so the search can use bisect, which is faster than the recursive search the server used
+
+    def add(self, player):
+        pos = bisect_right(self.elos, player.elo)
+        self.pool = self.pool[:pos] + [player] + self.pool[pos:]
+        self.elos = self.elos[:pos] + [player.elo] + self.elos[pos:]
+
+    def discard(self, player):
+        pos = self.pool.index(player)
+        del self.pool[pos]
+        del self.elos[pos]
+
+    def nearest(self, elo: int):
+        pos = bisect_right(self.elos, elo)
+        if pos == len(self.pool) or (pos > 0 and elo - self.elos[pos-1] <= self.elos[pos] - elo):
+            return self.pool[pos-1]
+        return self.pool[pos]
+
+def run(pool, queued: list, arrivals: list, lookups: list) -> dict:
+    "Returns the mean time of each operation in microseconds"
+    results = {}
+    started = time.perf_counter()
+    for player in arrivals:
+        pool.add(player)
+    results["insert"] = (time.perf_counter() - started) / len(arrivals) * 1e6
+    started = time.perf_counter()
+    for elo in lookups:
+        pool.nearest(elo)
+    results["nearest"] = (time.perf_counter() - started) / len(lookups) * 1e6
+    started = time.perf_counter()
+    for player in arrivals: #Players leaving the queue, such as on UNMATCHMAKE
+        pool.discard(player)
+    results["remove"] = (time.perf_counter() - started) / len(arrivals) * 1e6
+    return results
+
+def main(queued=100000, operations=2000):
+    rng = random.Random(1)
+    players = [QueuedPlayer(max(0, round(rng.gauss(1500, 400)))) for i in range(queued)]
+    arrivals = [QueuedPlayer(max(0, round(rng.gauss(1500, 400)))) for i in range(operations)]
+    lookups = [rng.randint(0, 3000) for i in range(operations)]
+    listPool = ListPool()
+    ordered = sorted(players, key=lambda p: p.elo)
+    listPool.pool, listPool.elos = ordered, [p.elo for p in ordered]
+    eloQueue = EloQueue(seed=1)
+    started = time.perf_counter()
+    for player in players:
+        eloQueue.add(player)
+    print(f"Queued {queued} players in an EloQueue in {time.perf_counter() - started:.2f}s, timing {operations} of each operation")
+    before = run(listPool, players, arrivals, lookups)
+    after = run(eloQueue, players, arrivals, lookups)
+    print(f"{'operation':<10}{'list us':>12}{'EloQueue us':>14}{'speedup':>10}")
+    for operation in before:
+        print(f"{operation:<10}{before[operation]:>12.2f}{after[operation]:>14.2f}{before[operation] / after[operation]:>9.1f}x")
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
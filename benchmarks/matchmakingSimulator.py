@@ -0,0 +1,234 @@
+#Runs the matchmaker against synthetic players on a simulated clock, so matchmaking strategies can be compared without real clients.
+#Every strategy sees exactly the same arrivals for a given seed. Run from the repository root with, for example:
+#   python benchmarks/matchmakingSimulator.py --rate 50 --duration 600 --abandon 0.01 --strategies batch greedy pools
+#Lock contention cannot be measured on the simulated clock, so --contention runs each strategy again for that many real seconds, with handler
+#threads queueing the same players at the arrival rate while passes run every tick, and reports how long each call waited for the lock.
+import sys
+import random
+import argparse
+import threading
+import time
+from collections import deque
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from matchmaking import EloQueue, Matchmaker, WideningWindow
+
+#Elo of the players in Paperwork/EloHistogram.png, as (lowest, highest, players) for each bar
+HISTOGRAM = [(-440, -170, 75), (-170, 100, 435), (100, 370, 915), (370, 640, 1295), (640, 910, 1370),
+             (910, 1180, 1865), (1180, 1450, 1885), (1450, 1720, 1355), (1720, 1990, 675), (1990, 2260, 130)]
+
+class SimulatedPlayer:
+    __slots__ = ("elo", "arrived")
+
+    def __init__(self, elo: int, arrived: float):
+        self.elo = elo
+        self.arrived = arrived
+
+class Clock: #Simulated time, moved on by the simulation rather than by waiting
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+class FixedPools: #The original matchmaking: four pools split at 1000/2000/3000, each pairing a random player with their nearest elo
+    def __init__(self, clock: Clock, seed: int):
+        self.__pools = [EloQueue() for i in range(4)]
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock() #The server held a lock per pool, but one lock is enough to measure how long a pass blocks handlers
+        self.__lockWaits = deque(maxlen=10000) #Timed the same way as Matchmaker times its lock
+
+    def __len__(self) -> int:
+        return sum(len(pool) for pool in self.__pools)
+
+    def __pool(self, elo: int) -> EloQueue:
+        return self.__pools[0 if elo <= 1000 else 1 if elo <= 2000 else 2 if elo <= 3000 else 3]
+
+    def __acquire(self):
+        started = time.perf_counter()
+        self.__lock.acquire()
+        self.__lockWaits.append(time.perf_counter() - started)
+
+    def lockWaits(self) -> list[float]:
+        return sorted(self.__lockWaits)
+
+    def add(self, player):
+        self.__acquire()
+        try:
+            self.__pool(player.elo).add(player)
+        finally:
+            self.__lock.release()
+
+    def discard(self, player) -> bool:
+        self.__acquire()
+        try:
+            return self.__pool(player.elo).discard(player)
+        finally:
+            self.__lock.release()
+
+    def match(self) -> list[tuple]:
+        pairs = []
+        self.__acquire()
+        try:
+            for pool in self.__pools:
+                while len(pool) >= 2:
+                    player = pool.at(self.__random.randint(0, len(pool) - 1))
+                    pool.discard(player)
+                    opponent = pool.nearest(player.elo)
+                    pool.discard(opponent)
+                    pairs.append((player, opponent))
+        finally:
+            self.__lock.release()
+        return pairs
+
+def sampleElo(rng: random.Random, distribution: str) -> int:
+    if distribution == "histogram":
+        low, high, count = rng.choices(HISTOGRAM, weights=[bar[2] for bar in HISTOGRAM])[0]
+        return rng.randint(low, high - 1)
+    elif distribution == "normal": #The same mean and spread as the histogram
+        return round(rng.gauss(1000, 500))
+    return rng.randint(-440, 2260)
+
+def percentile(values: list, p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+def arrivals(options) -> list[tuple[float, SimulatedPlayer, float]]:
+    "Every player that will arrive, with the time they will give up waiting, the same for every strategy"
+    rng = random.Random(options.seed)
+    players = []
+    now = rng.expovariate(options.rate)
+    while now < options.duration:
+        patience = rng.expovariate(options.abandon) if options.abandon > 0 else float("inf") #Seconds the player waits before giving up
+        players.append((now, SimulatedPlayer(sampleElo(rng, options.distribution), now), patience))
+        now += rng.expovariate(options.rate)
+    return players
+
+def create(strategy: str, clock, options):
+    if strategy == "pools":
+        return FixedPools(clock, options.seed)
+    window = WideningWindow(options.initial, options.widen, options.maximum, options.exponent)
+    return Matchmaker(window, clock, pairing=strategy, waitWeight=options.wait_weight)
+
+def contention(strategy: str, players: list, options) -> list[float]:
+    "Runs a strategy in real time for options.contention seconds, with handler threads queueing players while passes run. Returns the lock waits in seconds, sorted"
+    matchmaker = create(strategy, time.monotonic, options)
+    stopping = threading.Event()
+    started = time.monotonic()
+    def handle(handler: int): #Each handler queues every nth player at their arrival time, as the server's handler threads would on MATCHMAKE
+        for arrived, player, patience in players[handler::options.handlers]:
+            if arrived >= options.contention or stopping.wait(max(0.0, started + arrived - time.monotonic())):
+                return
+            matchmaker.add(SimulatedPlayer(player.elo, arrived)) #A fresh object, as the simulated run has already matched the original
+    handlers = [threading.Thread(target=handle, args=(i,), daemon=True) for i in range(options.handlers)]
+    for thread in handlers:
+        thread.start()
+    while not stopping.wait(options.tick):
+        matchmaker.match()
+        if time.monotonic() - started >= options.contention:
+            stopping.set()
+    for thread in handlers:
+        thread.join()
+    return matchmaker.lockWaits()
+
+def simulate(strategy: str, players: list, options) -> dict:
+    clock = Clock()
+    matchmaker = create(strategy, clock, options)
+    waits, gaps, passTimes = [], [], []
+    abandoned = 0
+    leaving = [] #type: list[tuple[float, SimulatedPlayer]] #When each queued player will give up, sorted
+    nextArrival = 0
+    tick = 0
+    started = time.perf_counter()
+    while tick * options.tick < options.duration:
+        tick += 1
+        passAt = tick * options.tick
+        while nextArrival < len(players) and players[nextArrival][0] <= passAt: #Players arrive through the tick, each at their own time
+            arrived, player, patience = players[nextArrival]
+            clock.now = arrived
+            matchmaker.add(player)
+            if patience != float("inf"):
+                leaving.append((arrived + patience, player))
+            nextArrival += 1
+        leaving.sort(key=lambda leaver: leaver[0])
+        while leaving and leaving[0][0] <= passAt:
+            leftAt, player = leaving.pop(0)
+            clock.now = leftAt
+            if matchmaker.discard(player): #False if they were matched before they gave up
+                abandoned += 1
+        clock.now = passAt
+        passStarted = time.perf_counter()
+        pairs = matchmaker.match()
+        passTimes.append(time.perf_counter() - passStarted)
+        for player, opponent in pairs:
+            waits.extend((passAt - player.arrived, passAt - opponent.arrived))
+            gaps.append(abs(player.elo - opponent.elo))
+    wall = time.perf_counter() - started
+    waits.sort()
+    gaps.sort()
+    passTimes.sort()
+    matched = len(gaps)
+    return {"strategy": strategy, "arrived": nextArrival, "matches": matched, "abandoned": abandoned, "queued": len(matchmaker),
+            "matchesPerSecond": matched / options.duration, "passMatchesPerSecond": matched / sum(passTimes) if sum(passTimes) else 0, "wall": wall,
+            "waits": waits, "gaps": gaps, "passTimes": passTimes, "lockWaits": contention(strategy, players, options) if options.contention else []}
+
+def report(results: list[dict], options):
+    print(f"{options.duration:.0f}s simulated, {options.rate} arrivals/s, {options.distribution} elo, abandon rate {options.abandon}/s, pass every {options.tick}s, "
+          f"window {options.initial} + {options.widen} * wait^{options.exponent} up to {options.maximum}")
+    rows = [
+        ("arrived", lambda r: r["arrived"], "{:.0f}"),
+        ("matches", lambda r: r["matches"], "{:.0f}"),
+        ("abandoned", lambda r: r["abandoned"], "{:.0f}"),
+        ("still queued", lambda r: r["queued"], "{:.0f}"),
+        ("matches/s simulated", lambda r: r["matchesPerSecond"], "{:.2f}"),
+        ("matches/s of pass time", lambda r: r["passMatchesPerSecond"], "{:.0f}"),
+        ("wait p50 s", lambda r: percentile(r["waits"], 0.5), "{:.2f}"),
+        ("wait p90 s", lambda r: percentile(r["waits"], 0.9), "{:.2f}"),
+        ("wait p99 s", lambda r: percentile(r["waits"], 0.99), "{:.2f}"),
+        ("wait max s", lambda r: r["waits"][-1] if r["waits"] else 0, "{:.2f}"),
+        ("gap mean", lambda r: sum(r["gaps"]) / len(r["gaps"]) if r["gaps"] else 0, "{:.1f}"),
+        ("gap p50", lambda r: percentile(r["gaps"], 0.5), "{:.0f}"),
+        ("gap p90", lambda r: percentile(r["gaps"], 0.9), "{:.0f}"),
+        ("gap p99", lambda r: percentile(r["gaps"], 0.99), "{:.0f}"),
+        ("gap max", lambda r: r["gaps"][-1] if r["gaps"] else 0, "{:.0f}"),
+        ("lock held per pass p50 ms", lambda r: percentile(r["passTimes"], 0.5) * 1000, "{:.3f}"),
+        ("lock held per pass max ms", lambda r: r["passTimes"][-1] * 1000 if r["passTimes"] else 0, "{:.3f}"),
+    ]
+    if options.contention:
+        rows += [(f"lock waits in {options.contention:.0f}s real", lambda r: len(r["lockWaits"]), "{:.0f}"),
+                 ("lock wait p50 ms", lambda r: percentile(r["lockWaits"], 0.5) * 1000, "{:.3f}"),
+                 ("lock wait p99 ms", lambda r: percentile(r["lockWaits"], 0.99) * 1000, "{:.3f}"),
+                 ("lock wait max ms", lambda r: r["lockWaits"][-1] * 1000 if r["lockWaits"] else 0, "{:.3f}")]
+    print(f"{'':<28}" + "".join(f"{r['strategy']:>12}" for r in results))
+    for label, value, form in rows:
+        print(f"{label:<28}" + "".join(f"{form.format(value(r)):>12}" for r in results))
+    print("Elo gap distribution (share of matches)")
+    edges = [0, 10, 25, 50, 100, 200, 400, 800]
+    for i, low in enumerate(edges):
+        high = edges[i + 1] if i + 1 < len(edges) else float("inf")
+        label = f"{low}-{high - 1}" if high != float("inf") else f"{low}+"
+        print(f"  {label:<26}" + "".join(f"{sum(1 for gap in r['gaps'] if low <= gap < high) / max(1, len(r['gaps'])):>12.1%}" for r in results))
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates matchmaking with synthetic players")
+    parser.add_argument("--strategies", nargs="+", default=["batch", "greedy", "pools"], choices=["batch", "greedy", "pools"])
+    parser.add_argument("--rate", type=float, default=20, help="players arriving per second")
+    parser.add_argument("--duration", type=float, default=600, help="seconds to simulate")
+    parser.add_argument("--tick", type=float, default=0.5, help="seconds between matchmaking passes, as matchmakeTick on the server")
+    parser.add_argument("--abandon", type=float, default=0.0, help="chance per second that a waiting player gives up")
+    parser.add_argument("--distribution", default="histogram", choices=["histogram", "normal", "uniform"])
+    parser.add_argument("--initial", type=float, default=50, help="starting window, in elo either side")
+    parser.add_argument("--widen", type=float, default=50, help="elo the window widens by per second")
+    parser.add_argument("--maximum", type=float, default=1000, help="widest window")
+    parser.add_argument("--exponent", type=float, default=1.0, help="shape of the widening curve")
+    parser.add_argument("--wait-weight", type=float, default=0.1, help="waitWeight of the batch pass")
+    parser.add_argument("--contention", type=float, default=0, metavar="SECONDS", help="also run each strategy for this many real seconds to time waits for the matchmaking lock")
+    parser.add_argument("--handlers", type=int, default=4, help="threads queueing players during the contention run")
+    parser.add_argument("--seed", type=int, default=1)
+    options = parser.parse_args()
+    players = arrivals(options)
+    results = [simulate(strategy, players, options) for strategy in options.strategies]
+    report(results, options)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import json
+import struct
+
+#A codec turns a command and its arguments into the bytes that get encrypted and sent, and back again.
+#Every session starts with the JSON codec, which includes the AUTH code in every message. A client can ask for the binary codec when it logs in,
+#after which AUTH is not sent again, as only someone holding the session key can produce a message that decrypts and passes its tag check.
+
+class CodecError(Exception):
+
+    def __init__(self, message: str):
+
+        super(CodecError, self).__init__("Codec Error: " + message)
+
+class UnauthorisedCodecError(CodecError):
+
+    def __init__(self):
+
+        super(UnauthorisedCodecError, self).__init__("Message has the wrong authorisation code")
+
+class JsonCodec:
+    "The original format. A json dictionary holding the AUTH code, the command and its arguments"
+    name = "json"
+    binary = False #Whether raw bytes can be sent as arguments
+
+    def __init__(self, auth: str):
+        self.auth = auth
+
+    def encode(self, command: str, args: tuple) -> bytes:
+        try:
+            return json.dumps({"AUTH": self.auth, "Command": command, "Args": args if args else ()}).encode("utf-8")
+        except (TypeError, ValueError) as error: #Such as raw bytes, which only the binary codec can carry
+            raise CodecError(f"Cannot encode {command} as json ({error})")
+
+    def decode(self, data: bytes) -> tuple:
+        try:
+            message = json.loads(data.decode("utf-8"))
+            auth, command, args = message["AUTH"], message["Command"], message["Args"]
+        except (ValueError, KeyError, TypeError) as error: #UnicodeDecodeError and JSONDecodeError are both ValueErrors
+            raise CodecError(f"Malformed message ({error})")
+        if auth != self.auth:
+            raise UnauthorisedCodecError
+        return command, args
+
+#Every command that is sent has a number, which is sent as a single byte instead of the name. New commands must be added to the end so the numbers of the others do not change.
+#Any command missing from the table is still sent, just by name.
+COMMANDS = ["LOGIN", "SIGNUP", "LOGGEDIN", "LOGINFAILED", "END", "MATCHMAKE", "UNMATCHMAKE", "MATCHMADE", "PRIORITYCOUNTRY", "DEPRIORITISECOUNTRY",
+            "PRIORITYBUFF", "DEPRIORITISEBUFF", "GETREWARDTUTORIAL", "GETREWARDWIN", "GETREWARDLOSS", "REWARD", "ELO", "IP", "RELAY", "SETUP", "TURN", "RESIGN"]
+COMMANDIDS = {command: i + 1 for i, command in enumerate(COMMANDS)} #0 means the name follows
+
+#Strings that appear in messages often enough to be worth sending as a single byte, such as buff types and country types. Append only, as with COMMANDS
+STATS = ["Towns", "Production", "Attack", "Defense", "SiegeAttack", "SiegeDefense", "Fortification"]
+STRINGS = ["COUNTRY", "BUFF", "AGG", "BAL", "DEF", "Player", "First"] + [size + stat for size in ("Minor", "Major") for stat in STATS] + [size + stat + "Buff" for size in ("Minor", "Major") for stat in STATS]
+STRINGIDS = {string: i for i, string in enumerate(STRINGS)}
+COUNTRYTYPES = ["AGG", "BAL", "DEF"]
+COUNTRYTYPEIDS = {countryType: i for i, countryType in enumerate(COUNTRYTYPES)}
+
+#Type tags written before each value
+NONE, FALSE, TRUE, INT, FLOAT, STR, INTERNED, BYTES, LIST, DICT, CARD, UINT32 = range(12)
+FLOATFORMAT = struct.Struct("!d")
+UINT32FORMAT = struct.Struct("!I") #Card hashes are 32 bit, and unpack faster as a fixed width than as a varint
+CARDFORMAT = struct.Struct("!HBH") #The towns, type and production of a country sent by Country.ToList, after its name
+
+def writeVarint(out: bytearray, value: int):
+    "Writes a non-negative integer 7 bits at a time, so small numbers take a single byte"
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def readVarint(data: bytes, pos: int) -> tuple:
+    "Reverses writeVarint, returning the value and the position after it"
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def isCard(value: list) -> bool:
+    "Whether a list has the shape of Country.ToList, [name, towns, type, production], with values small enough to pack"
+    return (len(value) == 4 and type(value[0]) is str and type(value[1]) is int and type(value[3]) is int and type(value[2]) is str and value[2] in COUNTRYTYPEIDS
+            and 0 <= value[1] <= 0xFFFF and 0 <= value[3] <= 0xFFFF)
+
+class BinaryCodec:
+    "Compact format negotiated at login. A numbered command followed by tagged, packed arguments"
+    name = "binary"
+    binary = True
+
+    def encode(self, command: str, args: tuple) -> bytes:
+        out = bytearray()
+        commandID = COMMANDIDS.get(command, 0)
+        out.append(commandID)
+        if not commandID:
+            self.__writeString(out, command)
+        writeVarint(out, len(args))
+        for arg in args:
+            self.__write(out, arg)
+        return bytes(out)
+
+    def decode(self, data: bytes) -> tuple:
+        try:
+            commandID = data[0]
+            if commandID:
+                command = COMMANDS[commandID - 1]
+                pos = 1
+            else:
+                length, pos = readVarint(data, 1)
+                command = data[pos:pos+length].decode("utf-8")
+                pos += length
+            count, pos = readVarint(data, pos)
+            args = []
+            for i in range(count):
+                value, pos = self.__read(data, pos)
+                args.append(value)
+        except (IndexError, UnicodeDecodeError, struct.error, TypeError, RecursionError) as error: #TypeError from a dictionary key that cannot be hashed, RecursionError from lists nested too deeply
+            raise CodecError(f"Malformed message ({error})")
+        if pos != len(data):
+            raise CodecError("Unexpected data after the end of the message")
+        return command, args
+
+    def __writeString(self, out: bytearray, value: str):
+        encoded = value.encode("utf-8")
+        writeVarint(out, len(encoded))
+        out += encoded
+
+    def __write(self, out: bytearray, value):
+        valueType = type(value)
+        if value is None:
+            out.append(NONE)
+        elif valueType is bool:
+            out.append(TRUE if value else FALSE)
+        elif valueType is int:
+            if 0x4000 <= value <= 0xFFFFFFFF:
+                out.append(UINT32)
+                out += UINT32FORMAT.pack(value)
+            else:
+                out.append(INT)
+                writeVarint(out, (value << 1) if value >= 0 else ((-value << 1) - 1)) #Zigzag encoding, so small negative numbers stay small
+        elif valueType is str:
+            stringID = STRINGIDS.get(value)
+            if stringID is None:
+                out.append(STR)
+                self.__writeString(out, value)
+            else:
+                out.append(INTERNED)
+                out.append(stringID)
+        elif valueType is list or valueType is tuple:
+            if isCard(value):
+                out.append(CARD)
+                self.__write(out, value[0])
+                out += CARDFORMAT.pack(value[1], COUNTRYTYPEIDS[value[2]], value[3])
+            else:
+                out.append(LIST)
+                writeVarint(out, len(value))
+                for item in value:
+                    self.__write(out, item)
+        elif valueType is dict:
+            out.append(DICT)
+            writeVarint(out, len(value))
+            for key, item in value.items():
+                self.__write(out, key)
+                self.__write(out, item)
+        elif valueType is float:
+            out.append(FLOAT)
+            out += FLOATFORMAT.pack(value)
+        elif valueType is bytes or valueType is bytearray:
+            out.append(BYTES)
+            writeVarint(out, len(value))
+            out += value
+        else:
+            raise CodecError(f"Cannot encode {valueType.__name__}")
+
+    def __read(self, data: bytes, pos: int) -> tuple:
+        tag = data[pos]
+        pos += 1
+        if tag == INT:
+            value = data[pos]
+            if value < 0x80: #Most numbers fit in one byte, so skip the varint loop
+                pos += 1
+            else:
+                value, pos = readVarint(data, pos)
+            return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+        elif tag == UINT32:
+            return UINT32FORMAT.unpack_from(data, pos)[0], pos + 4
+        elif tag == INTERNED:
+            return STRINGS[data[pos]], pos + 1
+        elif tag == STR:
+            length, pos = readVarint(data, pos)
+            return data[pos:pos+length].decode("utf-8"), pos + length
+        elif tag == NONE:
+            return None, pos
+        elif tag == TRUE:
+            return True, pos
+        elif tag == FALSE:
+            return False, pos
+        elif tag == LIST:
+            count, pos = readVarint(data, pos)
+            items = []
+            read = self.__read
+            append = items.append
+            for i in range(count):
+                item, pos = read(data, pos)
+                append(item)
+            return items, pos
+        elif tag == CARD:
+            name, pos = self.__read(data, pos)
+            towns, countryType, production = CARDFORMAT.unpack_from(data, pos)
+            return [name, towns, COUNTRYTYPES[countryType], production], pos + CARDFORMAT.size
+        elif tag == DICT:
+            count, pos = readVarint(data, pos)
+            items = {}
+            for i in range(count):
+                key, pos = self.__read(data, pos)
+                items[key], pos = self.__read(data, pos)
+            return items, pos
+        elif tag == FLOAT:
+            return FLOATFORMAT.unpack_from(data, pos)[0], pos + FLOATFORMAT.size
+        elif tag == BYTES:
+            length, pos = readVarint(data, pos)
+            return bytes(data[pos:pos+length]), pos + length
+        raise CodecError(f"Unknown type tag {tag}")
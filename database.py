@@ -0,0 +1,350 @@
+import sqlite3
+import threading
+import time
+from queue import LifoQueue, SimpleQueue, Empty
+from contextlib import contextmanager
+from concurrent.futures import Future
+import ServerErrors as e
+
+class DatabaseWriter: #A single thread that makes every change to the database. Writers queue here rather than contending for sqlite's write lock
+    #Whatever has queued up while the last batch was committing is run as the next batch, in one transaction, so a burst of writes costs one commit.
+    #Each job runs inside its own savepoint, so a job that fails (such as a sign up with a taken username) is undone without affecting the rest of its batch
+
+    def __init__(self, path: str, busyTimeout=5000, checkpointPages=1000, batchSize=256):
+        self.__batchSize = batchSize #Most jobs committed in one transaction
+        self.__queue = SimpleQueue() #type: SimpleQueue[tuple[float, function, Future] or None] #None tells the thread to stop
+        try:
+            self.__conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False) #Transactions are started and ended by the writer itself
+        except sqlite3.Error:
+            raise e.DatabaseAccessError
+        self.__conn.execute("PRAGMA journal_mode = WAL;") #Readers see the last commit and never wait for the writer, and a commit only appends to the log
+        self.__conn.execute("PRAGMA synchronous = NORMAL;") #Only sync at checkpoints. A power cut can lose the last commits, but cannot corrupt the database
+        self.__conn.execute(f"PRAGMA busy_timeout = {int(busyTimeout)};")
+        self.__conn.execute(f"PRAGMA wal_autocheckpoint = {int(checkpointPages)};") #Copies the log back into the database once it reaches this many pages
+        self.__conn.execute(f"PRAGMA journal_size_limit = {int(checkpointPages) * 4096 * 2};") #Stops the log file staying large after a burst of writes
+        self.__lock = threading.Lock()
+        self.__jobs = 0
+        self.__failed = 0
+        self.__commits = 0
+        self.__totalCommit = 0.0 #Time spent running and committing each batch
+        self.__maxCommit = 0.0
+        self.__totalLatency = 0.0 #Time from a job being queued to it being committed
+        self.__maxLatency = 0.0
+        self.__thread = threading.Thread(target=self.__run, name="DatabaseWriter", daemon=True)
+        self.__thread.start()
+
+    def submit(self, job: "function") -> Future: #Queues job(conn) to be run by the writer. The future holds what it returns, or what it raised, once committed
+        future = Future()
+        self.__queue.put((time.perf_counter(), job, future))
+        return future
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.__batchSize:
+                    break
+                try:
+                    item = self.__queue.get_nowait()
+                except Empty:
+                    break
+            if batch:
+                self.__commit(batch)
+            if item is None: #Everything queued before close has been written
+                self.__conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                self.__conn.close()
+                return
+
+    def __commit(self, batch: list):
+        started = time.perf_counter()
+        conn = self.__conn
+        outcomes = []
+        try:
+            conn.execute("BEGIN;")
+            for queued, job, future in batch:
+                conn.execute("SAVEPOINT job;")
+                try:
+                    result = job(conn)
+                except Exception as error:
+                    conn.execute("ROLLBACK TO job;")
+                    conn.execute("RELEASE job;")
+                    outcomes.append((future, None, error))
+                else:
+                    conn.execute("RELEASE job;")
+                    outcomes.append((future, result, None))
+            conn.execute("COMMIT;")
+        except sqlite3.Error as error: #The whole batch failed, so nothing in it was written
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            outcomes = [(future, None, error) for queued, job, future in batch]
+        committed = time.perf_counter()
+        with self.__lock:
+            self.__jobs += len(batch)
+            self.__commits += 1
+            self.__totalCommit += committed - started
+            self.__maxCommit = max(self.__maxCommit, committed - started)
+            for queued, job, future in batch:
+                self.__totalLatency += committed - queued
+                self.__maxLatency = max(self.__maxLatency, committed - queued)
+            self.__failed += sum(1 for future, result, error in outcomes if error is not None)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self) -> dict:
+        "Queue depth, and the batch commit time and queue-to-commit time of jobs in milliseconds"
+        with self.__lock:
+            return {"writeQueue": self.__queue.qsize(), "writes": self.__jobs, "failedWrites": self.__failed, "commits": self.__commits,
+                    "meanCommit": round(self.__totalCommit / self.__commits * 1000, 3) if self.__commits else 0, "maxCommit": round(self.__maxCommit * 1000, 3),
+                    "meanWriteLatency": round(self.__totalLatency / self.__jobs * 1000, 3) if self.__jobs else 0, "maxWriteLatency": round(self.__maxLatency * 1000, 3)}
+
+    def close(self): #Writes everything already queued, then stops the thread
+        self.__queue.put(None)
+        self.__thread.join()
+
+class DatabasePool: #A fixed set of long-lived sqlite connections shared by every thread that reads the database, and the single writer that changes it
+    #Connections are opened when first needed and then kept, so a command no longer pays for connecting, and because queries are parameterised
+    #rather than built with f-strings, each connection's statement cache means the same query text is only parsed once per connection.
+    #The database is in WAL mode, so reads run alongside each other and alongside the writer
+
+    def __init__(self, path: str, size=20, cachedStatements=256, busyTimeout=5000, checkpointPages=1000):
+        self.path = path
+        self.__busyTimeout = busyTimeout #Milliseconds a connection waits for a lock before giving up
+        self.__writer = DatabaseWriter(path, busyTimeout, checkpointPages) #Opened first, as it switches the database to WAL mode
+        self.__size = size #Maximum number of open connections, and so of threads using the database at once
+        self.__cachedStatements = cachedStatements
+        self.__idle = LifoQueue() #Most recently used connections are handed out first, as they are the most likely to be warm
+        self.__opened = 0
+        self.__openLock = threading.Lock()
+        self.__statsLock = threading.Lock()
+        self.__acquires = 0 #Time spent waiting for a free connection
+        self.__totalWait = 0.0
+        self.__maxWait = 0.0
+        self.__queries = 0 #Time spent running queries
+        self.__totalQuery = 0.0
+        self.__maxQuery = 0.0
+
+    def __open(self) -> sqlite3.Connection:
+        try:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=self.__cachedStatements) #Connections move between threads, but only one thread holds each at a time
+        except sqlite3.Error:
+            raise e.DatabaseAccessError
+        conn.execute(f"PRAGMA busy_timeout = {int(self.__busyTimeout)};")
+        return conn
+
+    def __acquire(self) -> sqlite3.Connection:
+        started = time.perf_counter()
+        try:
+            conn = self.__idle.get_nowait()
+        except Empty:
+            conn = None
+            with self.__openLock:
+                if self.__opened < self.__size:
+                    self.__opened += 1
+                    try:
+                        conn = self.__open()
+                    except e.DatabaseAccessError:
+                        self.__opened -= 1
+                        raise
+            if conn is None: #Every connection is in use, so wait for one to be released
+                conn = self.__idle.get()
+        waited = time.perf_counter() - started
+        with self.__statsLock:
+            self.__acquires += 1
+            self.__totalWait += waited
+            self.__maxWait = max(self.__maxWait, waited)
+        return conn
+
+    def __record(self, elapsed: float):
+        with self.__statsLock:
+            self.__queries += 1
+            self.__totalQuery += elapsed
+            self.__maxQuery = max(self.__maxQuery, elapsed)
+
+    @contextmanager
+    def connection(self):
+        "Borrows a connection for a group of reads. Changes should be made through write or submit instead, so they go through the writer"
+        conn = self.__acquire()
+        started = time.perf_counter()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self.__record(time.perf_counter() - started)
+            self.__idle.put(conn)
+
+    def query(self, sql: str, parameters=()) -> list:
+        "Runs a single SELECT and returns every row"
+        with self.connection() as conn:
+            return conn.execute(sql, parameters).fetchall()
+
+    def queryOne(self, sql: str, parameters=()) -> tuple or None:
+        "Runs a single SELECT and returns the first row, or None if there are no rows"
+        with self.connection() as conn:
+            return conn.execute(sql, parameters).fetchone()
+
+    def submit(self, job: "function") -> Future:
+        "Queues job(conn) to be run and committed by the writer without waiting for it"
+        return self.__writer.submit(job)
+
+    def write(self, job: "function"):
+        "Runs job(conn) on the writer and waits for it to be committed, returning its result or raising its error"
+        return self.__writer.submit(job).result()
+
+    def execute(self, sql: str, parameters=()) -> int:
+        "Runs and commits a single statement on the writer, returning the number of rows changed"
+        return self.write(lambda conn: conn.execute(sql, parameters).rowcount)
+
+    def stats(self) -> dict:
+        "Connection wait and query times, in milliseconds"
+        with self.__statsLock:
+            return {"connections": self.__opened, "acquires": self.__acquires,
+                    "meanWait": round(self.__totalWait / self.__acquires * 1000, 3) if self.__acquires else 0, "maxWait": round(self.__maxWait * 1000, 3),
+                    "queries": self.__queries, "meanQuery": round(self.__totalQuery / self.__queries * 1000, 3) if self.__queries else 0,
+                    "maxQuery": round(self.__maxQuery * 1000, 3), **self.__writer.stats()}
+
+    def close(self):
+        "Writes everything queued on the writer, then closes it and every idle connection"
+        self.__writer.close()
+        while True:
+            try:
+                conn = self.__idle.get_nowait()
+            except Empty:
+                return
+            conn.close()
+            with self.__openLock:
+                self.__opened -= 1
+
+class PriorityWriter: #Write-behind buffer for priority changes, so reshuffling a loadout costs one transaction instead of one per click
+    #Only the last priority set for each card is kept, so a card toggled several times between flushes is written once.
+    #The player's in-memory priority lists stay authoritative until then, as nothing reads priorities back from the database during a session
+
+    QUERIES = {"Country": "UPDATE Country SET priority = ? WHERE hash = ? AND playerID = ?;",
+               "Buff": "UPDATE Buff SET priority = ? WHERE hash = ? AND playerID = ?;"}
+
+    def __init__(self, database: DatabasePool, interval=2.0):
+        self.__database = database
+        self.__interval = interval #Seconds between each timed flush
+        self.__pending = {} #type: dict[str, dict[tuple[str, int], int]] #Username -> (table, hash) -> priority
+        self.__lock = threading.Lock()
+        self.__flushLock = threading.Lock() #Held from taking the pending changes until they are queued, so flushes reach the writer in the order they took them
+        self.__received = 0
+        self.__written = 0
+        self.__transactions = 0
+
+    def set(self, username: str, table: str, cardHash: int, priority: int): #Records a priority change, replacing any earlier one for the same card
+        if table not in self.QUERIES:
+            raise ValueError(f"No priority column in {table}")
+        with self.__lock:
+            self.__pending.setdefault(username, {})[(table, cardHash)] = priority
+            self.__received += 1
+
+    def flush(self, username=None): #Writes the pending changes of one player, or of every player if no username is given, in a single transaction
+        with self.__flushLock: #Otherwise a timed flush could take a card's priority, then be queued after a later flush of a newer one and overwrite it
+            with self.__lock:
+                if username is None:
+                    pending, self.__pending = self.__pending, {}
+                else:
+                    changes = self.__pending.pop(username, None)
+                    pending = {username: changes} if changes else {}
+            if not pending:
+                return
+            rows = {table: [] for table in self.QUERIES}
+            for player, changes in pending.items():
+                for (table, cardHash), priority in changes.items():
+                    rows[table].append((priority, cardHash, player))
+            def job(conn: sqlite3.Connection):
+                for table, parameters in rows.items():
+                    if parameters:
+                        conn.executemany(self.QUERIES[table], parameters)
+            future = self.__database.submit(job) #The writer runs jobs in the order they are queued
+        try:
+            future.result() #Waited on outside the flush lock, so other flushes can queue behind this one meanwhile
+        except Exception:
+            with self.__lock: #Put the changes back so the next flush retries them, without overwriting anything newer
+                for player, changes in pending.items():
+                    newer = self.__pending.setdefault(player, {})
+                    for card, priority in changes.items():
+                        newer.setdefault(card, priority)
+            raise
+        with self.__lock:
+            self.__written += sum(len(parameters) for parameters in rows.values())
+            self.__transactions += 1
+
+    def run(self, stopping: threading.Event): #Flushes every interval until the server stops, then once more so nothing is lost
+        print("Priority writer started")
+        while not stopping.wait(self.__interval):
+            try:
+                self.flush()
+            except Exception as error:
+                print(f"Could not write priority changes: {error}")
+        self.flush()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"pending": sum(len(changes) for changes in self.__pending.values()), "received": self.__received, "written": self.__written, "transactions": self.__transactions}
+
+class ResultsWriter: #Queues the elo, wins and losses of players after each battle and writes them in batches from a single thread, so a handler never waits to save a result
+    QUERY = "UPDATE Player SET elo = ?, wins = ?, losses = ? WHERE username = ?;"
+
+    def __init__(self, database: DatabasePool, interval=1.0):
+        self.__database = database
+        self.__interval = interval #Seconds between each batch
+        self.__queue = SimpleQueue() #type: SimpleQueue[tuple[float, tuple]] #When each result was queued, and its rows
+        self.__retry = [] #Results from a batch that failed, written first next time
+        self.__lock = threading.Lock()
+        self.__results = 0
+        self.__rows = 0
+        self.__transactions = 0
+        self.__totalLatency = 0.0 #Time from a result being queued to it being committed
+        self.__maxLatency = 0.0
+
+    def record(self, *players: tuple): #Queues the result of one battle, as (username, elo, wins, losses) for each player. The players in a result are always written in the same transaction
+        self.__queue.put((time.perf_counter(), players))
+
+    def flush(self): #Writes every queued result in a single transaction. Only called from the writer thread, so results are written in the order they were queued
+        results, self.__retry = self.__retry, []
+        while True:
+            try:
+                results.append(self.__queue.get_nowait())
+            except Empty:
+                break
+        if not results:
+            return
+        rows = [(elo, wins, losses, username) for queued, players in results for username, elo, wins, losses in players]
+        try:
+            self.__database.write(lambda conn: conn.executemany(self.QUERY, rows))
+        except Exception:
+            self.__retry = results
+            raise
+        committed = time.perf_counter()
+        with self.__lock:
+            self.__results += len(results)
+            self.__rows += len(rows)
+            self.__transactions += 1
+            for queued, players in results:
+                self.__totalLatency += committed - queued
+                self.__maxLatency = max(self.__maxLatency, committed - queued)
+
+    def run(self, stopping: threading.Event): #Writes a batch every interval until the server stops, then writes whatever is left
+        print("Results writer started")
+        while not stopping.wait(self.__interval):
+            try:
+                self.flush()
+            except Exception as error:
+                print(f"Could not write battle results, retrying: {error}")
+        self.flush()
+        print("Results writer stopped")
+
+    def stats(self) -> dict:
+        "Results still queued, and the time from queueing to commit in milliseconds"
+        with self.__lock:
+            return {"queued": self.__queue.qsize() + len(self.__retry), "results": self.__results, "rows": self.__rows, "transactions": self.__transactions,
+                    "meanLatency": round(self.__totalLatency / self.__results * 1000, 3) if self.__results else 0, "maxLatency": round(self.__maxLatency * 1000, 3)}
@@ -0,0 +1,326 @@
+import threading
+import random
+import itertools
+import heapq
+import time
+from collections import deque
+from contextlib import contextmanager
+
+#The players waiting for a battle are kept in elo order in an indexable skip list. Each node is linked on a random number of levels, and each link records
+#how many players it skips over, so inserting, removing, finding the nearest elo and finding the nth player all take O(log n) time
+
+MAXLEVELS = 24 #Enough for millions of players at one level per halving
+
+class EloNode:
+    __slots__ = ("key", "player", "next", "width")
+
+    def __init__(self, key: tuple, player, levels: int):
+        self.key = key #(elo, arrival order), so players with the same elo stay in the order they queued
+        self.player = player
+        self.next = [None] * levels #type: list[EloNode] #The following node on each level
+        self.width = [1] * levels #type: list[int] #How many players each of those links passes over
+
+END = EloNode((float("inf"), 0), None, 0) #Every level ends here, so searches never have to check for None
+
+class EloQueue: #Thread-safe queue of players ordered by elo. Players are removed by handle rather than searched for
+    "Players waiting to be matchmade, in elo order"
+
+    def __init__(self, seed=None):
+        self.__head = EloNode((float("-inf"), 0), None, MAXLEVELS)
+        self.__head.next = [END] * MAXLEVELS
+        self.__top = 1 #Number of levels in use. Searches start from the highest of these rather than from MAXLEVELS
+        self.__nodes = {} #type: dict[object, EloNode] #Each queued player's node, to remove them without searching
+        self.__arrivals = itertools.count()
+        self.__random = random.Random(seed) #Only used to pick the number of levels of each node
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__nodes)
+
+    def __contains__(self, player) -> bool:
+        return player in self.__nodes
+
+    def __iter__(self): #Iterates over a snapshot of the players, in elo order
+        return iter(self.players())
+
+    def __repr__(self) -> str:
+        return f"EloQueue({len(self)} players)"
+
+    def __levels(self) -> int:
+        levels = 1
+        while levels < MAXLEVELS and self.__random.random() < 0.5:
+            levels += 1
+        return levels
+
+    def __chain(self, key: tuple) -> tuple[list, list]: #Finds the last node before key on every level, and how many players the search passed on each
+        chain = [self.__head] * MAXLEVELS
+        steps = [0] * MAXLEVELS
+        node = self.__head
+        for level in range(self.__top - 1, -1, -1):
+            while node.next[level].key < key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return chain, steps
+
+    def __before(self, key: tuple) -> EloNode: #The last node before key. The same search as __chain without recording the path, for lookups
+        node = self.__head
+        for level in range(self.__top - 1, -1, -1):
+            following = node.next[level]
+            while following.key < key:
+                node = following
+                following = node.next[level]
+        return node
+
+    def add(self, player):
+        "Queues a player at their current elo. A player already queued is left where they are"
+        with self.__lock:
+            if player in self.__nodes:
+                return
+            node = EloNode((player.elo, next(self.__arrivals)), player, self.__levels())
+            while self.__top < len(node.next): #A new level starts out as a single link from the head past every player
+                self.__head.width[self.__top] = len(self.__nodes) + 1
+                self.__top += 1
+            chain, steps = self.__chain(node.key)
+            passed = 0 #Players between the node before on this level and the new node
+            for level in range(len(node.next)):
+                before = chain[level]
+                node.next[level] = before.next[level]
+                before.next[level] = node
+                node.width[level] = before.width[level] - passed
+                before.width[level] = passed + 1
+                passed += steps[level]
+            for level in range(len(node.next), self.__top): #Links above the new node now pass over one more player
+                chain[level].width[level] += 1
+            self.__nodes[player] = node
+
+    def __unlink(self, node: EloNode):
+        chain, steps = self.__chain(node.key)
+        for level in range(len(node.next)):
+            before = chain[level]
+            before.width[level] += node.width[level] - 1
+            before.next[level] = node.next[level]
+        for level in range(len(node.next), self.__top):
+            chain[level].width[level] -= 1
+        del self.__nodes[node.player]
+
+    def discard(self, player) -> bool:
+        "Removes a player if they are queued. Returns whether they were"
+        with self.__lock:
+            node = self.__nodes.get(player)
+            if node is None:
+                return False
+            self.__unlink(node)
+            return True
+
+    def __at(self, index: int) -> EloNode:
+        node = self.__head
+        remaining = index + 1
+        for level in range(self.__top - 1, -1, -1):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        return node
+
+    def at(self, index: int):
+        "Gets the player at a position in elo order"
+        with self.__lock:
+            if not 0 <= index < len(self.__nodes):
+                raise IndexError("EloQueue index out of range")
+            return self.__at(index).player
+
+    def __nearest(self, elo: int) -> EloNode or None:
+        below = self.__before((elo, -1))
+        above = below.next[0]
+        if below is self.__head:
+            return above if above is not END else None
+        if above is END or elo - below.key[0] <= above.key[0] - elo: #Picks the lower neighbour on a tie
+            return below
+        return above
+
+    def nearest(self, elo: int):
+        "Gets the queued player whose elo is closest, or None if the queue is empty"
+        with self.__lock:
+            node = self.__nearest(elo)
+            return node.player if node is not None else None
+
+    def players(self) -> list:
+        "Every queued player, in elo order"
+        with self.__lock:
+            players = []
+            node = self.__head.next[0]
+            while node is not END:
+                players.append(node.player)
+                node = node.next[0]
+            return players
+
+class WideningWindow: #How far either side of their own elo a player will look for an opponent, growing the longer they have queued
+    "initial + rate * wait ** exponent elo, up to maximum. An exponent above 1 widens slowly at first, then quickly"
+
+    def __init__(self, initial=50, rate=50, maximum=1000, exponent=1.0):
+        self.initial = initial
+        self.rate = rate #Elo added per second of waiting, for an exponent of 1
+        self.maximum = maximum
+        self.exponent = exponent
+
+    def __call__(self, wait: float) -> float:
+        return min(self.maximum, self.initial + self.rate * wait ** self.exponent)
+
+    def __repr__(self) -> str:
+        return f"WideningWindow({self.initial}, {self.rate}, {self.maximum}, {self.exponent})"
+
+class Matchmaker: #Every waiting player in one elo index. Two players can be matched once their windows overlap
+    "Queues players and pairs them off by elo. The clock can be replaced to run it faster than real time"
+
+    PAIRINGS = ("batch", "greedy")
+
+    def __init__(self, window=None, clock=time.monotonic, history=10000, pairing="batch", waitWeight=0.1):
+        if pairing not in self.PAIRINGS:
+            raise ValueError(f"Unknown pairing {pairing}, expected one of {self.PAIRINGS}")
+        self.window = window if window is not None else WideningWindow()
+        self.pairing = pairing #batch chooses the lowest total cost for the whole queue at once, greedy takes the closest pair first
+        self.waitWeight = waitWeight #How much more each second of waiting makes it cost to leave a player unmatched in a batch pass
+        self.__clock = clock
+        self.__queue = EloQueue()
+        self.__queuedAt = {} #When each waiting player joined the queue
+        self.__lock = threading.Lock() #Held for a whole pass, so players cannot leave part way through being matched
+        self.__matched = 0
+        self.__abandoned = 0 #Players that left the queue before they were matched
+        self.__waits = deque(maxlen=history) #type: deque[float] #Seconds each recently matched player waited
+        self.__gaps = deque(maxlen=history) #type: deque[int] #Elo difference of each recent match
+        self.__lockWaits = deque(maxlen=history) #type: deque[float] #Real seconds each recent add, discard and pass waited for the lock, whatever the clock
+
+    def __len__(self) -> int:
+        return len(self.__queue)
+
+    @contextmanager
+    def __locked(self): #Holds the lock, timing how long it took to get, so contention between handlers and passes can be seen in stats
+        started = time.perf_counter()
+        with self.__lock:
+            self.__lockWaits.append(time.perf_counter() - started)
+            yield
+
+    def add(self, player):
+        "Queues a player at their current elo, starting their wait"
+        with self.__locked():
+            if player not in self.__queue:
+                self.__queuedAt[player] = self.__clock()
+                self.__queue.add(player)
+
+    def discard(self, player) -> bool:
+        "Removes a player who has stopped waiting. Returns whether they were queued"
+        with self.__locked():
+            if not self.__queue.discard(player):
+                return False
+            del self.__queuedAt[player]
+            self.__abandoned += 1
+            return True
+
+    def waiting(self, player) -> dict or None:
+        "How long a queued player has waited and how wide their window is, or None if they are not queued"
+        with self.__lock:
+            queuedAt = self.__queuedAt.get(player)
+            if queuedAt is None:
+                return None
+            wait = self.__clock() - queuedAt
+            return {"wait": round(wait, 3), "window": round(self.window(wait), 1)}
+
+    def match(self) -> list[tuple]:
+        "Runs a matchmaking pass over a snapshot of the queue. Returns the pairs made, which have left the queue"
+        with self.__locked():
+            now = self.__clock()
+            players = self.__queue.players() #In elo order, so the best opponent for anyone is always one of the players either side of them
+            waits = [now - self.__queuedAt[player] for player in players]
+            windows = [self.window(wait) for wait in waits]
+            if self.pairing == "batch":
+                chosen = self.__pairBatch(players, waits, windows)
+            else:
+                chosen = self.__pairGreedy(players, windows)
+            pairs = []
+            for i, j in chosen:
+                pairs.append((players[i], players[j]))
+                self.__record(players[i], players[j], players[j].elo - players[i].elo, now)
+            return pairs
+
+    def __pairBatch(self, players: list, waits: list, windows: list) -> list[tuple[int, int]]:
+        #Chooses the pairs with the lowest total cost in one scan. Leaving a player unmatched costs their window, scaled up by how long they have waited,
+        #and matching two neighbours costs their elo gap. A pair is only allowed if the two windows overlap, so the gap is never more than the two
+        #players would cost unmatched, and the scan only leaves a player out when that lets closer or longer-waiting players be matched instead.
+        #best[k] is the lowest cost of the first k players, who are either left unmatched or matched with the player before them
+        count = len(players)
+        best = [0.0] * (count + 1)
+        pairedLast = [False] * (count + 1) #Whether best[k] matches player k-1 with player k-2
+        for k in range(1, count + 1):
+            best[k] = best[k-1] + windows[k-1] * (1 + self.waitWeight * waits[k-1])
+            if k >= 2:
+                gap = players[k-1].elo - players[k-2].elo
+                if gap <= windows[k-1] + windows[k-2] and best[k-2] + gap < best[k]:
+                    best[k] = best[k-2] + gap
+                    pairedLast[k] = True
+        chosen = []
+        k = count
+        while k >= 2: #Walks back through the choices that gave best[count]
+            if pairedLast[k]:
+                chosen.append((k - 2, k - 1))
+                k -= 2
+            else:
+                k -= 1
+        chosen.reverse()
+        return chosen
+
+    def __pairGreedy(self, players: list, windows: list) -> list[tuple[int, int]]:
+        #Repeatedly takes the closest pair of neighbours whose windows overlap. Kept to compare against the batch pass
+        count = len(players)
+        before = list(range(-1, count - 1)) #Neighbours among the players not yet matched
+        after = list(range(1, count + 1))
+        def candidate(i: int, j: int) -> tuple or None: #(elo gap, lower player, upper player) if the two windows overlap
+            gap = players[j].elo - players[i].elo
+            return (gap, i, j) if gap <= windows[i] + windows[j] else None
+        candidates = [pair for pair in (candidate(i, i + 1) for i in range(count - 1)) if pair is not None]
+        heapq.heapify(candidates)
+        matched = [False] * count
+        chosen = []
+        while candidates:
+            gap, i, j = heapq.heappop(candidates)
+            if matched[i] or matched[j]: #One of them has already been matched to someone closer
+                continue
+            matched[i] = matched[j] = True
+            chosen.append((i, j))
+            outer, inner = before[i], after[j] #The players either side of the pair are now next to each other
+            if outer >= 0:
+                after[outer] = inner
+            if inner < count:
+                before[inner] = outer
+            if outer >= 0 and inner < count:
+                pair = candidate(outer, inner)
+                if pair is not None:
+                    heapq.heappush(candidates, pair)
+        return chosen
+
+    def __record(self, player, opponent, gap: int, now: float):
+        for p in (player, opponent):
+            self.__queue.discard(p)
+            self.__waits.append(now - self.__queuedAt.pop(p))
+        self.__gaps.append(gap)
+        self.__matched += 2
+
+    def lockWaits(self) -> list[float]:
+        "Real seconds each recent add, discard and pass waited for the lock, sorted"
+        with self.__lock:
+            return sorted(self.__lockWaits)
+
+    def stats(self) -> dict:
+        "Queue depth, percentiles of the wait of recently matched players in seconds and of the elo gap of recent matches, and of the wait for the lock in milliseconds"
+        with self.__lock: #Not timed, so reading the stats does not count towards them
+            now = self.__clock()
+            waiting = sorted(now - queuedAt for queuedAt in self.__queuedAt.values())
+            waits = sorted(self.__waits)
+            gaps = sorted(self.__gaps)
+            lockWaits = sorted(wait * 1000 for wait in self.__lockWaits)
+            matched, abandoned = self.__matched, self.__abandoned
+        percentile = lambda values, p: round(values[min(len(values) - 1, int(len(values) * p))], 3) if values else 0
+        return {"queued": len(waiting), "longestWaiting": round(waiting[-1], 3) if waiting else 0, "matched": matched, "abandoned": abandoned,
+                "meanWait": round(sum(waits) / len(waits), 3) if waits else 0, "p50Wait": percentile(waits, 0.5), "p90Wait": percentile(waits, 0.9),
+                "p99Wait": percentile(waits, 0.99), "maxWait": round(waits[-1], 3) if waits else 0,
+                "meanGap": round(sum(gaps) / len(gaps), 1) if gaps else 0, "p90Gap": percentile(gaps, 0.9), "maxGap": gaps[-1] if gaps else 0,
+                "p50LockWait": percentile(lockWaits, 0.5), "p99LockWait": percentile(lockWaits, 0.99), "maxLockWait": round(lockWaits[-1], 3) if lockWaits else 0}
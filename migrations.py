@@ -0,0 +1,76 @@
+import sqlite3
+import time
+import ServerErrors as e
+
+#Every change to the database schema is a numbered migration. The number of the last one applied is kept in the database's user_version,
+#so the server only runs the ones a database has not had yet. New migrations must be added to the end, and a migration must never be changed once released.
+
+def createTables(conn: sqlite3.Connection): #The original schema from databaseSetup.sql, so an empty database can be set up by the server
+    conn.execute("""CREATE TABLE IF NOT EXISTS Player (
+                    username VARCHAR(15) PRIMARY KEY,
+                    password TEXT,
+                    wins INTEGER UNSIGNED,
+                    losses INTEGER UNSIGNED,
+                    elo INTERGER UNSIGNED);""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS Buff (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    type VARCHAR(20),
+                    priority INTEGER UNSIGNED,
+                    hash NUMERIC,
+                    playerID VARCHAR(15),
+                    FOREIGN KEY (playerID) REFERENCES Player(id));""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS Country (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name VARCHAR(15),
+                    playerID VARCHAR(15),
+                    towns INTEGER UNSIGNED,
+                    type VARCHAR(15),
+                    production INTEGER UNSIGNED,
+                    priority INTEGER UNSIGNED,
+                    hash NUMERIC,
+                    FOREIGN KEY (playerID) REFERENCES Player(id));""")
+
+def indexCards(conn: sqlite3.Connection): #Indexes cards by owner then hash, and makes each card unique to its owner
+    for table in ("Country", "Buff"):
+        #Rewards used to be inserted without checking properly for duplicates, so keep the oldest copy of each card, prioritised if any copy was
+        conn.execute(f"UPDATE {table} SET priority = 1 WHERE id IN (SELECT MIN(id) FROM {table} GROUP BY playerID, hash HAVING COUNT(*) > 1 AND MAX(priority) = 1);")
+        conn.execute(f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY playerID, hash);")
+        #Serves both the inventory load (playerID alone) and the priority updates (playerID and hash)
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}PlayerHash ON {table} (playerID, hash);")
+
+MIGRATIONS = [createTables, indexCards] #Migration n is MIGRATIONS[n-1]
+
+def schemaVersion(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+def migrate(path: str) -> tuple[int, int]:
+    "Brings the database at path up to the latest schema. Each migration runs in its own transaction along with the version change. Returns the versions before and after"
+    try:
+        conn = sqlite3.connect(path, isolation_level=None) #Transactions are started and ended here rather than by the sqlite3 module
+    except sqlite3.Error:
+        raise e.DatabaseAccessError
+    try:
+        startVersion = schemaVersion(conn)
+        if startVersion > len(MIGRATIONS):
+            raise e.DatabaseMigrationError(startVersion, f"database is newer than this server, which only knows up to version {len(MIGRATIONS)}")
+        for version in range(startVersion + 1, len(MIGRATIONS) + 1):
+            migration = MIGRATIONS[version - 1]
+            started = time.perf_counter()
+            try:
+                conn.execute("BEGIN IMMEDIATE;") #Takes the write lock straight away, so nothing else can write part way through
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {version};")
+                conn.execute("COMMIT;")
+            except sqlite3.Error as error:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK;")
+                raise e.DatabaseMigrationError(version, str(error))
+            print(f"Applied database migration {version} ({migration.__name__}) in {time.perf_counter() - started:.3f}s")
+        return startVersion, len(MIGRATIONS)
+    finally:
+        conn.close()
+
+if __name__ == "__main__": #Migrates a database without starting the server: python migrations.py [path]
+    import sys
+    before, after = migrate(sys.argv[1] if len(sys.argv) > 1 else "playerData.sqlite3")
+    print(f"Database at version {after}" + (f", migrated from version {before}" if before != after else ", already up to date"))
@@ -0,0 +1,150 @@
+import struct
+import os
+import tempfile
+import threading
+from collections import deque
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+#Every message sent between the server and clients, or between two players, is sent as a frame: a 4 byte big-endian length header followed by the payload.
+#TCP is a stream, so one recv() can return part of a message or several messages at once. The receiving side feeds whatever arrives into a FrameBuffer,
+#which hands back whole payloads once they have fully arrived.
+
+HEADER = struct.Struct("!I") #Length header placed before every payload
+MAXFRAME = 1 << 20 #Largest payload accepted, so a corrupt header cannot make the receiver buffer gigabytes
+
+class FrameError(Exception):
+
+    def __init__(self, message: str):
+
+        super(FrameError, self).__init__("Frame Error: " + message)
+
+def frame(payload: bytes) -> bytes:
+    "Prefixes the payload with its length"
+    if len(payload) > MAXFRAME:
+        raise FrameError(f"Payload of {len(payload)} bytes is too large to send")
+    return HEADER.pack(len(payload)) + payload
+
+class FrameBuffer:
+    "Reassembles frames from the chunks returned by recv()"
+    def __init__(self):
+        self.__data = bytearray()
+        self.__frames = deque() #type: deque[bytes]
+
+    def feed(self, data: bytes):
+        "Adds received bytes to the buffer, splitting off any frames that are now complete"
+        self.__data += data
+        while len(self.__data) >= HEADER.size:
+            length = HEADER.unpack_from(self.__data)[0]
+            if length > MAXFRAME:
+                raise FrameError(f"Incoming frame of {length} bytes is too large")
+            end = HEADER.size + length
+            if len(self.__data) < end: #The rest of this frame has not arrived yet
+                break
+            self.__frames.append(bytes(self.__data[HEADER.size:end]))
+            del self.__data[:end]
+
+    def pop(self) -> bytes or None:
+        "Returns the oldest complete frame, or None if no frame has fully arrived"
+        if self.__frames:
+            return self.__frames.popleft()
+        return None
+
+    def __len__(self) -> int:
+        return len(self.__frames)
+
+async def readFrame(reader) -> bytes or None:
+    "Reads one frame from an asyncio StreamReader. Returns None if the stream closed"
+    try:
+        header = await reader.readexactly(HEADER.size)
+        length = HEADER.unpack(header)[0]
+        if length > MAXFRAME:
+            raise FrameError(f"Incoming frame of {length} bytes is too large")
+        return await reader.readexactly(length)
+    except EOFError: #IncompleteReadError is a subclass of EOFError
+        return None
+
+def saveKeyFile(filename: str, data: bytes):
+    "Writes a private key that only the current user can read. It goes to a temporary file that then replaces the old one, so a crash part way through never leaves a truncated key behind"
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp") #mkstemp creates the file with mode 0600
+    try:
+        with os.fdopen(descriptor, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, filename)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+
+#Once a session key has been agreed, every message is encrypted with a SessionCipher instead of RSA, using ChaCha20-Poly1305 from the cryptography package.
+#Each direction has its own key derived from the shared key, so a message can never be reflected back to the side that sent it.
+#Every message carries a counter that is one higher than the last one sent that way. It is the nonce, so it is covered by the tag, and the receiver
+#rejects any message whose counter is not higher than the last it accepted, so a captured message cannot be replayed or reordered within the session.
+
+class SessionCipher:
+    "Authenticated symmetric cipher for a single session or battle. One end is created with initiator set and the other without"
+    KEYSIZE = 32 #Length of the shared key, which is what gets sent under RSA
+    COUNTER = struct.Struct("!Q") #Sent in front of every message
+    TAGSIZE = 16
+
+    def __init__(self, key: bytes, initiator: bool):
+        if len(key) != self.KEYSIZE:
+            raise FrameError(f"Session key must be {self.KEYSIZE} bytes, not {len(key)}")
+        self.key = key
+        self.codec = None #The codec negotiated for messages sent under this key, or None for json
+        forward, backward = self.__deriveKey(key, b"COC initiator to responder"), self.__deriveKey(key, b"COC responder to initiator")
+        self.__sendCipher = ChaCha20Poly1305(forward if initiator else backward)
+        self.__receiveCipher = ChaCha20Poly1305(backward if initiator else forward)
+        self.__sent = 0 #Counter of the last message sent
+        self.__received = 0 #Counter of the last message accepted
+        self.sending = threading.Lock() #Held from encrypting a message until it has been written, so messages from different threads reach the socket in counter order
+
+    @staticmethod
+    def __deriveKey(key: bytes, info: bytes) -> bytes:
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(key)
+
+    @classmethod
+    def generate(cls, initiator: bool) -> "SessionCipher":
+        "Creates a cipher with a new random key"
+        return cls(os.urandom(cls.KEYSIZE), initiator)
+
+    def encrypt(self, message: bytes) -> bytes:
+        "Encrypts a message of any length, returning the counter followed by the ciphertext and tag"
+        self.__sent += 1
+        counter = self.COUNTER.pack(self.__sent)
+        return counter + self.__sendCipher.encrypt(bytes(4) + counter, message, None) #The counter padded to the 12 byte nonce
+
+    def decrypt(self, data: bytes) -> bytes:
+        "Checks the counter and tag and decrypts a message produced by the other end's encrypt"
+        if len(data) < self.COUNTER.size + self.TAGSIZE:
+            raise FrameError("Encrypted payload is too short")
+        counter = data[:self.COUNTER.size]
+        number = self.COUNTER.unpack(counter)[0]
+        if number <= self.__received:
+            raise FrameError(f"Message {number} is a replay or out of order, expected a counter above {self.__received}")
+        try:
+            message = self.__receiveCipher.decrypt(bytes(4) + counter, data[self.COUNTER.size:], None)
+        except InvalidTag:
+            raise FrameError("Message failed authentication")
+        self.__received = number #Only moved on once the message is known to be genuine
+        return message
+
+def encryptMessage(message: bytes, key: SessionCipher) -> bytes:
+    "Encrypts a message with the session cipher"
+    return key.encrypt(message)
+
+def decryptMessage(data: bytes, key: SessionCipher) -> bytes:
+    "Reverses encryptMessage"
+    return key.decrypt(data)
+
+SECRETCOMMANDS = {"LOGIN", "SIGNUP", "IP"} #Commands whose arguments carry credentials or the battle key
+
+def loggable(command: str, args) -> str:
+    "Returns the arguments of a message as they may be logged, with those of SECRETCOMMANDS hidden"
+    return "<redacted>" if command in SECRETCOMMANDS else str(args)
@@ -1,14 +1,30 @@
 import socket
 import threading
+import asyncio
 import sqlite3
+from database import DatabasePool, PriorityWriter, ResultsWriter
+from migrations import migrate
+from matchmaking import Matchmaker, WideningWindow
 import sys
 import random
+import time
 import ServerErrors as e
-import json 
 import rsa
+import weakref
+import os
+import ipaddress
+import selectors
+import secrets
+import base64
+import signal
+from protocol import frame, FrameBuffer, FrameError, readFrame, SessionCipher, encryptMessage, decryptMessage, loggable
+from codec import JsonCodec, BinaryCodec, CodecError, UnauthorisedCodecError
 from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
 
 AUTH = str(sha256("121212".encode("ascii"), usedforsecurity=True).digest()) #Authentication code for network transmissions
+JSONCODEC = JsonCodec(AUTH) #Used until a client asks for the binary codec at login
+BINARYCODEC = BinaryCodec()
 
 #The following hash is not cryptographically secure, and should only be used to compare objects
 def Hash(string: str) -> int:
@@ -104,7 +120,7 @@ class MajorFortificationBuff(FortificationBuff, MajorBuff):
     "Subclass for Major Fortification Buffs that inherits from FortificationBuff and MajorBuff. +2 increase"
     def __init__(self):
         
-        super(MajorFortificationBuff).__init__(2)
+        super(MajorFortificationBuff, self).__init__(2)
 
 class AttackBuff(MultiplicativeBuff):
     "Subclass for Attack Buffs, inherits from Multiplicative as all attack changes should be multiplicative"
@@ -211,6 +227,12 @@ class DefensiveCountry(Country):
         super(DefensiveCountry, self).__init__(production, towns, name)
         self.type = "DEF"
 
+#Registries used to build cards from the type names stored in the database and sent to clients
+BUFFTYPES = {cls.__name__[:-4]: cls for cls in (MinorProductionBuff, MajorProductionBuff, MinorTownsBuff, MajorTownsBuff, MinorFortificationBuff, MajorFortificationBuff,
+                                                 MinorAttackBuff, MajorAttackBuff, MinorSiegeAttackBuff, MajorSiegeAttackBuff, MinorDefenseBuff, MajorDefenseBuff,
+                                                 MinorSiegeDefenseBuff, MajorSiegeDefenseBuff)} #type: dict[str, type[Buff]] #eg "MinorAttack" -> MinorAttackBuff
+COUNTRYTYPES = {"AGG": AggressiveCountry, "BAL": BalancedCountry, "DEF": DefensiveCountry} #type: dict[str, type[Country]]
+
 class Player:
 
     def __init__(self, username, countries=[], prioritycountries=[], buffs=[], prioritybuffs=[], wins=0, losses=0, elo=0, socket=None, key=None):
@@ -220,178 +242,521 @@ class Player:
         self.buffs = buffs #type: list[Buff]
         self.prioritycountries = prioritycountries #type: list[Country]
         self.prioritybuffs = prioritybuffs #type: list[Buff]
+        self.countryHashes = {hash(c) for c in countries} #type: set[int] #Hashes of owned cards, so a reward can be checked against the inventory in constant time
+        self.buffHashes = {hash(b) for b in buffs} #type: set[int]
         self.wins = wins #type: int
         self.losses = losses #type: int
         self.elo = elo #type: int
         self.Battle = None
         self.enemy = None
         self.socket = socket #type: socket.socket
-        self.key = key #type: rsa.PublicKey
+        self.key = key #type: SessionCipher #The cipher agreed with this player at login
     
     def __repr__(self) -> str:
         return self.username
 
 class Battle:
 
-    def __init__(self, player1: Player, player2: Player):
-        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) #Socket specifying using the tcp/ip protocol
-        self.__host = socket.gethostbyname(socket.gethostname()) #Server ip address
-        self.__port = 11035 #Server port
-        self.__socket.bind((self.__host, self.__port))
-        self.__socket.listen() #Allows the socket to act like a server
+    def __init__(self, player1: Player, player2: Player, relay=False):
         self.player1 = player1
         self.player1.enemy = player2
         self.player2 = player2
         self.player2.enemy = player1
         self.player1.Battle = self
         self.player2.Battle = self
-        self.player1first = bool(random.randint(0, 1))   
-        p1connected = False
-        p2connected = False
-        while not (p1connected and p2connected): #Waits for both players to connect
-            try:
-                player, address = self.__socket.accept()
-                player.settimeout(1)
-            except:
-                continue
-            if address[0] == self.player1.socket.getpeername()[0]:#Checks the player by comparing IP addresses
-                self.p1socket = player
-                p1connected = True
-                print(f"{player1} connected")
-            elif address[0] == self.player2.socket.getpeername()[0]:
-                self.p2socket = player
-                p2connected = True
-                print(f"{player2} connected")
-
-        SERVER.send("IP", self.p1socket, self.player1.key, self.player2.socket.getpeername()[0], self.player1first) #Sends player 2s IP address to player 1 and whether player 1 goes first
-        key2 = self.player2.key.save_pkcs1("PEM")
-        while SERVER.receive(self.p1socket)[0] != "RECEIVED": #Wait for confirmation
-            continue
-        self.p1socket.send(key2) #Sends player 2s public key to player 1
-        SERVER.send("IP", self.p2socket, self.player2.key, self.player1.socket.getpeername()[0], not self.player1first) #Sends player 1s IP address to player 2 and whether player 2 goes first
-        key1 = self.player1.key.save_pkcs1("PEM") #Get player 1s key
-        while SERVER.receive(self.p2socket)[0] != "RECEIVED": #Waits for confirmation
-            continue
-        self.p2socket.send(key1) #Sends player 1s key to player 2
-        print(f"Battle between {player1.username} and {player2.username} initialised!")
-        self.p1socket.close() #Close the sockets
-        self.p2socket.close()
-        self.__socket.close()
+        self.player1first = bool(random.randint(0, 1))
+        self.tokens = {secrets.token_hex(16): player1, secrets.token_hex(16): player2} #One-time tokens sent with MATCHMADE, which the players present to the rendezvous to identify themselves
+        self.sockets = {} #type: dict[Player, socket.socket] #Setup connections of the players that have arrived so far
+        self.created = time.monotonic()
+        self.relay = relay #If set, the server forwards the battle messages rather than the players connecting to each other
+        self.relayed = 0 #Messages and bytes forwarded in relay mode
+        self.relayedBytes = 0
+        self.relayTime = 0.0 #Total and worst time spent forwarding a message
+        self.relayMaxTime = 0.0
+        self.__relayLock = threading.Lock() #Both players' handlers record into the same counters
+        self.settled = False #Whether the result has been applied to the players
+        self.__resultLock = threading.Lock() #Both players report the result, so only the first report is applied
+
+    def tokenFor(self, player: Player) -> str: #Gets the token issued to one of the players
+        for token, p in self.tokens.items():
+            if p is player:
+                return token
+
+    def setup(self): #Run on a setup thread by the rendezvous once both players have connected
+        p1socket = self.sockets[self.player1]
+        p2socket = self.sockets[self.player2]
+        for sock in (p1socket, p2socket):
+            sock.setblocking(True)
+            sock.settimeout(5) #A player that stops reading cannot hold up this setup thread for long
+        try:
+            battleKey = secrets.token_bytes(SessionCipher.KEYSIZE).hex() #Both players encrypt their peer to peer traffic with this key, which only ever travels under their own session ciphers
+            if self.relay: #No address is sent in relay mode, which tells the players to send their battle messages through the server
+                p1ip = p2ip = None
+            else:
+                p1ip = self.player1.socket.getpeername()[0] #Both addresses are read first, as a player may close their session as soon as they have their setup data
+                p2ip = self.player2.socket.getpeername()[0]
+            battleCodec = "binary" if self.player1.key.codec is BINARYCODEC and self.player2.key.codec is BINARYCODEC else "json" #The players can only use the binary codec with each other if they both support it
+            #Both messages are encrypted before either is sent. They use the players' session ciphers but not their session sockets, so otherwise
+            #the first player could relay a message to the second that is numbered before the second player's setup data, which they read first
+            with self.player1.key.sending:
+                p1message = SERVER.seal("IP", self.player1.key, p2ip, self.player1first, battleKey, battleCodec) #Sends player 2s IP address to player 1, whether player 1 goes first, the battle key and codec
+            with self.player2.key.sending:
+                p2message = SERVER.seal("IP", self.player2.key, p1ip, not self.player1first, battleKey, battleCodec) #Sends player 1s IP address to player 2 and whether player 2 goes first
+            p1socket.sendall(p1message)
+            p2socket.sendall(p2message)
+            print(f"Battle between {self.player1.username} and {self.player2.username} initialised!")
+        except OSError as error:
+            print(f"Battle between {self.player1.username} and {self.player2.username} could not be set up: {error}")
+        finally:
+            p1socket.close() #Close the sockets
+            p2socket.close()
+
+    def settle(self, winner: Player, loser: Player) -> bool: #Updates the elo, wins and losses of both players from their ratings before the battle. Returns False if the result had already been applied
+        with self.__resultLock:
+            if self.settled:
+                return False
+            self.settled = True
+            winnerElo = ELOCALC.calculateNewElo(winner.elo, ELOCALC.calculateProbabilityOfWin(winner.elo, loser.elo), 1)
+            loserElo = ELOCALC.calculateNewElo(loser.elo, ELOCALC.calculateProbabilityOfWin(loser.elo, winner.elo), 0)
+            winner.elo, loser.elo = winnerElo, loserElo
+            winner.wins += 1
+            loser.losses += 1
+            return True
+
+    def recordRelay(self, size: int, elapsed: float): #Counts a forwarded message
+        with self.__relayLock:
+            self.relayed += 1
+            self.relayedBytes += size
+            self.relayTime += elapsed
+            self.relayMaxTime = max(self.relayMaxTime, elapsed)
+
+    def relayStats(self) -> dict: #Throughput and forwarding time of a relayed battle
+        duration = time.monotonic() - self.created
+        return {"messages": self.relayed, "bytes": self.relayedBytes, "messagesPerSecond": round(self.relayed / duration, 2) if duration else 0,
+                "meanForward": round(self.relayTime / self.relayed * 1000, 3) if self.relayed else 0, "maxForward": round(self.relayMaxTime * 1000, 3)} #Times in milliseconds
+
+class Rendezvous: #A single listener on port 11035 shared by every battle being set up, rather than each battle binding its own
+
+    def __init__(self, host: str, port=11035, timeout=30):
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__socket.bind((host, port))
+        self.__socket.listen(128)
+        self.__socket.setblocking(False)
+        self.__selector = selectors.DefaultSelector() #Waits on the listener and every setup connection at once, so no thread is ever blocked in accept()
+        self.__selector.register(self.__socket, selectors.EVENT_READ, None)
+        self.__pending = {} #type: dict[str, Battle] #Unused tokens and the battles they belong to
+        self.__lock = threading.Lock() #Tokens are registered by the matchmaker thread
+        self.__timeout = timeout #Seconds a battle or unidentified connection is kept waiting before it is dropped
+        self.__lastExpired = time.monotonic()
+        self.completed = 0
+        self.expired = 0
+        self.__totalSetup = 0.0
+        self.__setups = Supervisor("Battle setup") #Sending the setup data blocks, so it is done off the selector thread
+
+    def register(self, *battles: Battle): #Makes the battles' tokens valid. Must be called before MATCHMADE is sent
+        with self.__lock:
+            for battle in battles:
+                for token in battle.tokens:
+                    self.__pending[token] = battle
+
+    def run(self, stopping: threading.Event):
+        print("Battle rendezvous started")
+        while not stopping.is_set():
+            for key, mask in self.__selector.select(timeout=1):
+                try:
+                    if key.data is None:
+                        self.__accept()
+                    else:
+                        self.__read(key.fileobj, key.data)
+                except Exception as error: #One bad connection must not stop every other battle being set up
+                    print(f"Rendezvous error: {error!r}")
+            if time.monotonic() - self.__lastExpired >= 1:
+                self.__expire()
+
+    def __accept(self):
+        try:
+            conn, address = self.__socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as error: #Eg the connection was aborted before it was accepted, or there are no file descriptors left
+            print(f"Rendezvous could not accept a connection: {error}")
+            return
+        conn.setblocking(False)
+        self.__selector.register(conn, selectors.EVENT_READ, (FrameBuffer(), time.monotonic(), address[0])) #Each connection keeps its own buffer until it has sent its token. The address is kept as the peer may be gone by the time it is logged
+
+    def __read(self, conn: socket.socket, state: tuple):
+        buffer = state[0]
+        try:
+            data = conn.recv(4096)
+            if not data:
+                raise ConnectionResetError("Connection closed before a token was sent")
+            buffer.feed(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, FrameError):
+            self.__selector.unregister(conn)
+            conn.close()
+            return
+        token = buffer.pop()
+        if token is None: #The token has not fully arrived yet
+            return
+        self.__selector.unregister(conn)
+        token = token.decode("utf-8", "replace")
+        with self.__lock:
+            battle = self.__pending.pop(token, None) #Popped so each token can only be used once
+        if battle is None:
+            print(f"Rejected unknown battle token from {state[2]}")
+            conn.close()
+            return
+        battle.sockets[battle.tokens[token]] = conn
+        if len(battle.sockets) == 2:
+            self.completed += 1
+            self.__totalSetup += time.monotonic() - battle.created
+            self.__setups.submit(battle.setup)
+
+    def __expire(self): #Drops battles that a player never arrived for and connections that never sent a token
+        now = time.monotonic()
+        self.__lastExpired = now
+        for key in list(self.__selector.get_map().values()):
+            if key.data is not None and now - key.data[1] > self.__timeout:
+                self.__selector.unregister(key.fileobj)
+                key.fileobj.close()
+        with self.__lock:
+            stale = {battle for battle in self.__pending.values() if now - battle.created > self.__timeout}
+            for token in [token for token, battle in self.__pending.items() if battle in stale]:
+                del self.__pending[token]
+        for battle in stale:
+            self.expired += 1
+            print(f"Battle between {battle.player1.username} and {battle.player2.username} expired")
+            for conn in battle.sockets.values():
+                conn.close()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            pending = len(set(self.__pending.values()))
+        return {"pending": pending, "completed": self.completed, "expired": self.expired,
+                "meanSetup": round(self.__totalSetup / self.completed, 3) if self.completed else 0}
 
 class Thread(threading.Thread): #Custom class for threading
 
     def __init__(self, target: "function", *args):
         super(Thread, self).__init__(target=target, args=args)
         self.finished = False
+        self.failed = False
+        self.onFinish = None #type: function #Called with the thread once its target has returned or raised
     
     def start(self):
         super(Thread, self).start()
         return
 
+    def run(self):
+        try:
+            super(Thread, self).run()
+        except BaseException:
+            self.failed = True
+            raise
+        finally:
+            self.finished = True
+            if self.onFinish is not None:
+                self.onFinish(self)
+
+class Supervisor: #Starts worker threads as soon as they are submitted and reaps them when they finish, so nothing has to poll them
+
+    def __init__(self, name: str, limit=None):
+        self.name = name
+        self.__live = set() #type: set[Thread]
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(limit) if limit is not None else None #If a limit is given, submit waits until a thread finishes
+        self.finished = 0
+        self.failed = 0
+
+    def submit(self, target: "function", *args) -> Thread:
+        if self.__slots is not None:
+            self.__slots.acquire()
+        thread = Thread(target, *args)
+        thread.onFinish = self.__reap
+        with self.__lock:
+            self.__live.add(thread)
+        thread.start()
+        return thread
+
+    def __reap(self, thread: Thread): #Runs on the finishing thread itself
+        with self.__lock:
+            self.__live.discard(thread)
+            self.finished += 1
+            if thread.failed:
+                self.failed += 1
+        if self.__slots is not None:
+            self.__slots.release()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"live": len(self.__live), "finished": self.finished, "failed": self.failed}
+
+class StreamSocket: #Wraps an asyncio stream so it can be used anywhere a player socket is expected
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self.reader = reader
+        self.writer = writer
+        self.__loop = loop
+        self.__peername = writer.get_extra_info("peername")
+
+    def send(self, data: bytes) -> int: #Safe to call from any thread, the write itself is always performed by the event loop
+        self.__loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    sendall = send #The stream writer always writes everything it is given
+
+    def getpeername(self) -> tuple:
+        return self.__peername
+
+    def settimeout(self, timeout: float):
+        pass #Reads are awaited by the session coroutine, so there is nothing to time out
+
+    def close(self):
+        self.__loop.call_soon_threadsafe(self.writer.close)
+
+class BanList: #In memory index of banned addresses, reloaded whenever the ban file changes
+
+    def __init__(self, filename: str, checkInterval=1.0):
+        self.__filename = filename
+        self.__checkInterval = checkInterval #Minimum seconds between checks of the file's modification time, so a flood of connections does not mean a flood of stat calls
+        self.__lastChecked = 0.0
+        self.__mtime = None
+        self.__addresses = frozenset() #type: frozenset[str] #Exactly banned IPs
+        self.__networks = {} #type: dict[int, frozenset[int]] #Banned CIDR ranges, as a set of network addresses for each prefix length
+        self.__lock = threading.Lock()
+        self.rejected = 0 #Number of connections refused
+        self.__reload()
+
+    def __reload(self): #Rebuilds the index if the file has changed since it was last read
+        self.__lastChecked = time.monotonic()
+        try:
+            mtime = os.stat(self.__filename).st_mtime
+        except OSError: #No ban file means nobody is banned
+            mtime = None
+        if mtime == self.__mtime:
+            return
+        addresses = set()
+        networks = {}
+        if mtime is not None:
+            try:
+                with open(self.__filename, "r", encoding="utf-8") as f:
+                    for line in f:
+                        line = line.split("#")[0].strip() #Allows comments and blank lines
+                        if not line:
+                            continue
+                        try:
+                            if "/" in line:
+                                network = ipaddress.ip_network(line, strict=False)
+                                networks.setdefault((network.version, network.prefixlen), set()).add(int(network.network_address))
+                            else:
+                                addresses.add(str(ipaddress.ip_address(line)))
+                        except ValueError:
+                            print(f"Ignoring invalid ban entry {line!r}")
+            except (OSError, UnicodeDecodeError) as error: #The file was replaced part way through or saved badly. Keeping the old index and mtime means the next check tries again
+                print(f"Could not reload the ban list, keeping the previous one: {error}")
+                return
+        self.__addresses = frozenset(addresses) #Swapped in whole, so lookups on other threads never see a half built index
+        self.__networks = {key: frozenset(value) for key, value in networks.items()}
+        self.__mtime = mtime
+        print(f"Ban list loaded: {len(addresses)} addresses, {sum(len(n) for n in networks.values())} ranges")
+
+    def isBanned(self, ip: str) -> bool: #Checks an IP against the exact bans, then each range prefix length. Counts the connection if it is refused
+        if time.monotonic() - self.__lastChecked >= self.__checkInterval:
+            with self.__lock:
+                if time.monotonic() - self.__lastChecked >= self.__checkInterval:
+                    self.__reload()
+        banned = ip in self.__addresses
+        if not banned and self.__networks:
+            try:
+                address = ipaddress.ip_address(ip)
+            except ValueError:
+                address = None
+            if address is not None:
+                bits = 32 if address.version == 4 else 128
+                value = int(address)
+                for (version, prefixlen), networks in self.__networks.items():
+                    if version == address.version and (value >> (bits - prefixlen) << (bits - prefixlen)) in networks:
+                        banned = True
+                        break
+        if banned:
+            self.rejected += 1
+        return banned
+
+    def stats(self) -> dict:
+        return {"addresses": len(self.__addresses), "ranges": sum(len(n) for n in self.__networks.values()), "rejected": self.rejected}
+
 class Server: #Class containing server methods and attributes
 
-    def __init__(self):
+    def __init__(self, asyncMode=False, maxSessions=50000, workers=32, statsInterval=60, matchmakeTick=0.5, matchmakeWindow=None, matchmakePairing="batch", banFile="banlist.txt", relay=False, database="playerData.sqlite3", databaseConnections=20, priorityInterval=2.0, resultsInterval=1.0):
 
+        timings = {} #Seconds taken by each stage of start up
+        started = time.perf_counter()
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) #Socket specifying using the tcp/ip protocol
         self.__socket.settimeout(1)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) #Allows a restarted server to bind straight away rather than waiting for old connections to time out
         self.__host = socket.gethostbyname(socket.gethostname()) #Server ip address
         self.__port = 11034 #Server port
-        self.__pubkey, self.__privkey = rsa.newkeys(2048)
+        stage = time.perf_counter()
         self.__CountryNames = [] #type: list[str]
         with open("countries.txt", "r") as f:
             for line in f.readlines():
                 self.__CountryNames.append(line.strip())
+        timings["countries.txt load"] = time.perf_counter() - stage
+        stage = time.perf_counter()
+        self.__banList = BanList(banFile)
+        timings["ban list load"] = time.perf_counter() - stage
+        stage = time.perf_counter()
+        schemaFrom, schemaTo = migrate(database) #Brings the database schema up to date before anything uses it
+        print(f"Database schema at version {schemaTo}" + (f" (migrated from {schemaFrom})" if schemaFrom != schemaTo else ""))
+        timings["database migration"] = time.perf_counter() - stage
+        stage = time.perf_counter()
         self.__socket.bind((self.__host, self.__port))
         self.__socket.listen() #Allows the socket to act like a server
+        self.__rendezvous = Rendezvous(self.__host) #Shared by every battle being set up
+        timings["socket bind"] = time.perf_counter() - stage
+        stage = time.perf_counter()
 
         self.__serverThreads = [] #type: list[Thread] #Threads performing server tasks
-        self.__handlerThreads = [] #type: list[Thread] #Threads handling players
-        self.__battleThreads = [] #type: list[Thread]
-        #Multiple pools to allow for multiple matchmakes at one time and to allow more fair matchmaking
-        self.__pool1 = [] #type: list[Player] #Matchmaking pool for Elo 0-1000 inclusive
-        self.__pool2 = [] #type: list[Player] #Matchmaking pool for Elo 1001-1500 inclusive
-        self.__pool3 = [] #type: list[Player] #Matchmaking pool for Elo 1501-2000 inclusive
-        self.__pool4 = [] #type: list[Player] #Matchmaking pool for Elo 2001-2400 inclusive
+        self.__handlers = Supervisor("Handler") #Threads handling players
+        self.__statsInterval = statsInterval #Seconds between each status report
+        self.__stopping = threading.Event()
+        self.__matchmaker = Matchmaker(matchmakeWindow or WideningWindow(), pairing=matchmakePairing) #Every waiting player in one elo index. Each player accepts a wider range of elo the longer they wait
+        self.__matchmakeCondition = threading.Condition() #Signalled whenever a player is added to a pool
+        self.__matchmakeTick = matchmakeTick #Seconds between matchmaking passes while players are waiting
 
         self.__loggedInLock = threading.BoundedSemaphore(10000) #A lock allowing only 10000 users to be logged-in at once
-        self.__databaseLock = threading.BoundedSemaphore(20) #A lock allowing a maximum of 10 database connections at a time
-        self.__pool1Lock = threading.Lock() #Resource locks on the relevant matchmaking pools, to prevent players being put into battles more than once at a time.
-        self.__pool2Lock = threading.Lock() 
-        self.__pool3Lock = threading.Lock()
-        self.__pool4Lock = threading.Lock()
-        a = Thread(self.__accept)
-        cht = Thread(self.__checkHandlerThreads)
-        cht2 = Thread(self.__checkHandlerThreads)
+        self.__database = DatabasePool(database, databaseConnections) #Long-lived connections shared by every thread, which also limits how many use the database at once
+        self.__priorities = PriorityWriter(self.__database, priorityInterval) #Priority changes are buffered and written together rather than one transaction per click
+        self.__results = ResultsWriter(self.__database, resultsInterval) #Battle results are queued and saved in batches by their own thread
+        self.__frameBuffers = weakref.WeakKeyDictionary() #type: dict[socket.socket, FrameBuffer] #Partially received frames for each connection
+        self.__frameBuffersLock = threading.Lock()
+        self.__relay = relay #If set, battles are relayed through the server instead of the players connecting to each other on port 11036
+        self.__relayedBattles = weakref.WeakSet() #type: set[Battle] #Relayed battles that are still referenced by a player
+        self.__asyncMode = asyncMode #If set, connections are served by coroutines on an event loop instead of a thread each
+        self.__maxSessions = maxSessions #Maximum number of concurrent sessions in async mode
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ServerWorker") #Runs blocking RSA and database work for the event loop
+        if self.__asyncMode:
+            a = Thread(self.__serveAsync)
+        else:
+            a = Thread(self.__accept)
+        mon = Thread(self.__monitor)
         mtchmke = Thread(self.__matchmake)
+        rendezvous = Thread(self.__rendezvous.run, self.__stopping)
+        priorities = Thread(self.__priorities.run, self.__stopping)
+        results = Thread(self.__results.run, self.__stopping)
+        self.__writers = [priorities, results] #Threads that must finish writing before the server exits
+        self.__matchmakeThread = mtchmke
         self.__serverThreads.append(a) #Adds a thread that accepts new connections
-        self.__serverThreads.append(cht) #Adds a thread that checks handler threads are all running
-        self.__serverThreads.append(cht2) #Adds a thread that checks handler threads are all running
+        self.__serverThreads.append(mon) #Adds a thread that periodically reports the server status
         self.__serverThreads.append(mtchmke) #Adds a thread that goes through the matchmaking pool
+        self.__serverThreads.append(rendezvous) #Adds a thread that sets up every battle
+        self.__serverThreads.append(priorities) #Adds a thread that writes buffered priority changes
+        self.__serverThreads.append(results) #Adds a thread that saves battle results
         for thread in self.__serverThreads:
             thread.start()
-        print(f"Server Live at {self.__host, self.__port}")
-
-    def send(self, command: str, conn: socket.socket, key: rsa.PublicKey, *args): #Sends a message through a socket
-        message = {"AUTH": AUTH, "Command": command, "Args": ()} #Creates dictionary containing the command and any arguments
-        if args:
-            message["Args"] = args
-        print("sent", message)
-        encMessage = json.dumps(message).encode("utf-8") #Converts dictionary into json and encodes it using utf-8
-        conn.send(rsa.encrypt(encMessage, key)) #Sends the command through the socket
+        timings["thread start"] = time.perf_counter() - stage
+        print(f"Server Live at {self.__host, self.__port}{' (async mode)' if self.__asyncMode else ''}{' (relaying battles)' if self.__relay else ''}")
+        print(f"Started in {time.perf_counter() - started:.3f}s:", ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items()))
+
+    def send(self, command: str, conn: socket.socket, key: SessionCipher, *args): #Sends a message through a socket
+        with key.sending: #Handler, matchmaker and rendezvous threads can all send to the same player, and the client rejects messages that arrive out of counter order
+            conn.sendall(self.seal(command, key, *args)) #Sends the command through the socket as a single frame
+
+    def seal(self, command: str, key: SessionCipher, *args) -> bytes: #Encodes and encrypts a message into a frame. The caller must hold key.sending until the frame has been written
+        print("sent", command, loggable(command, args))
+        encMessage = self.__codec(key).encode(command, args) #Encodes the command and any arguments with the codec agreed for this session
+        return frame(encryptMessage(encMessage, key))
+
+    def receiveFrame(self, conn: socket.socket) -> bytes or None: #Returns the next whole frame from the connection, or None if the socket timed out first
+        buffer = self.__frameBuffers.get(conn) #Each connection keeps its own buffer, as part of the next frame may have arrived with the last one
+        if buffer is None:
+            with self.__frameBuffersLock:
+                buffer = self.__frameBuffers.setdefault(conn, FrameBuffer())
+        while not len(buffer):
+            try:
+                data = conn.recv(4096)
+            except socket.timeout:
+                return None
+            if not data:
+                raise ConnectionResetError("Connection closed by the client")
+            buffer.feed(data)
+        return buffer.pop()
     
-    def receive(self, conn: socket.socket) -> tuple[str, str]:
+    def receive(self, conn: socket.socket, key: SessionCipher) -> tuple[str, str]: #Key is the session cipher agreed with the client
         try:
-            data = conn.recv(2048)
-        except Exception as e:
-            if str(e) == socket.errorTab[10054] or str(e) == socket.errorTab[10053]: #If the socket has closed unexpectedly, tell the caller that the client disconnected
-                return "DISCONNECT", None
+            data = self.receiveFrame(conn)
+        except (OSError, FrameError): #If the socket has closed unexpectedly or the stream is corrupt, tell the caller that the client disconnected
+            return "DISCONNECT", None
+        if data is None:
             return None, None
-        new = rsa.decrypt(data, self.__privkey) #Decrypt and load the message, check the authorization code
-        data = json.loads(new.decode("utf-8"))
-        command = data["Command"]
-        args = data["Args"]
-        if data["AUTH"] != AUTH:
+        return self.__decode(data, key)
+
+    def __decode(self, data: bytes, key: SessionCipher) -> tuple[str, str]:
+        new = decryptMessage(data, key) #Decrypt and load the message, check the authorization code
+        try:
+            command, args = self.__codec(key).decode(new)
+        except UnauthorisedCodecError:
             return False, False
-        print(f"Received {command}: {args}")
+        print(f"Received {command}: {loggable(command, args)}")
         return command, args
+
+    def __codec(self, key: SessionCipher) -> JsonCodec or BinaryCodec: #Gets the codec agreed for a session. Everything starts with json
+        if isinstance(key, SessionCipher) and key.codec is not None:
+            return key.codec
+        return JSONCODEC
+
+    def __negotiateCodec(self, key: SessionCipher, info: list): #Switches the session to the binary codec if the client asked for it when logging in. Called once LOGGEDIN has been sent
+        if len(info) > 2 and info[2] == BINARYCODEC.name:
+            key.codec = BINARYCODEC
         
     def __accept(self): #Accepts new connections
         print("Accepting Connections")
-        while True: #Loops, waiting for connections
+        while not self.__stopping.is_set(): #Loops, waiting for connections
             try:
                 client, address = self.__socket.accept()
             except:
                 continue
-            if address not in open("banlist.txt", "r"): #Checks if IP is banned
-                print(f"Connection from {address} accepted!")
-                t = Thread(self.__login, client, address)
-                self.__handlerThreads.append(t) #Creates a new thread to handle the player
-
-    def __checkHandlerThreads(self): #Checks threads are active and starts them if not, if thread finished it deletes them
-        print("Handler threads monitor started")
-        while True:
-            for thread in self.__handlerThreads:
-                if not thread.is_alive():
-                    try:
-                        thread.start()
-                    except RuntimeError:
-                        try:
-                            self.__handlerThreads.remove(thread) #Thread not explicitly deleted as handled more efficiently by garbage collector
-                                                                 #Threads can also change IDs which can cause the del() function to raise an error. I cannot find a solution to this
-                        except:
-                            pass
+            if self.__banList.isBanned(address[0]): #Checks if IP is banned before any thread is started for it
+                client.close()
+                continue
+            print(f"Connection from {address} accepted!")
+            self.__handlers.submit(self.__login, client, address) #Starts a new thread to handle the player, which is reaped once it finishes
+
+    def __monitor(self): #Reports the server status every statsInterval seconds. Sleeps in between rather than polling
+        print("Server monitor started")
+        while not self.__stopping.wait(self.__statsInterval):
+            print("Server status:", self.stats())
+
+    def shutdown(self): #Stops the server threads and waits for every buffered priority change and battle result to be written
+        if self.__stopping.is_set(): #Already shutting down, such as a SIGTERM arriving during Ctrl+C
+            return
+        print("Server shutting down")
+        self.__stopping.set()
+        with self.__matchmakeCondition: #The matchmaking thread may be waiting for players, so wake it to see that the server is stopping
+            self.__matchmakeCondition.notify_all()
+        self.__matchmakeThread.join(5) #Not waited on for long, as it could be part way through sending to a client that has stopped reading
+        for thread in self.__writers:
+            thread.join()
+        self.__database.close()
+
+    def stats(self) -> dict: #Returns a snapshot of the server's thread counts
+        return {"handlers": self.__handlers.stats(), "battles": self.__rendezvous.stats(), "matchmaking": self.matchmakingStats(), "bans": self.__banList.stats(), "relay": self.relayStats(), "database": self.__database.stats(), "priorities": self.__priorities.stats(), "results": self.__results.stats()}
 
     def __login(self, client: socket.socket, address: str): #Login function
         with self.__loggedInLock: #Uses log in lock. If more than 10000 threads are using this, it will wait until a space is available
             failed = True
             while failed:
                 try:
-                    data = client.recv(4096)
-                    servkey = self.__pubkey.save_pkcs1("PEM") #Attempts to get the server key and the client key then send the server key and load the client key
-                    client.send(servkey)
-                except:
+                    data = self.receiveFrame(client)
+                except (OSError, FrameError): #The client left before sending its key
+                    client.close()
+                    return
+                if data is None:
                     continue
-                key = rsa.PublicKey.load_pkcs1(data, "PEM")
+                key = self.__exchangeKeys(client, data)
                 failed = False
             failed = True
             while failed:
@@ -399,398 +764,379 @@ class Server: #Class containing server methods and attributes
                 received = False
                 while not received:
                     try:
-                        command, info = self.receive(client) 
+                        command, info = self.receive(client, key)
                         received = True
                         if command == False:
                             print("Unauthorized connection from ", client.getpeername()[0]) #If the receive function detected unauthorised request, break off the thread
                             break
                     except:
                         pass
-                print(command, info, "received")
+                print(command, loggable(command, info), "received")
                 if command == "SIGNUP": #Received if player wants a new account
-                    username, password = info #Splits info into variables
+                    username, password = info[:2] #Splits info into variables. A third argument may name the codec the client wants
                     try:
                         self.__signup(username, password)
                         failed = False
                         self.send("LOGGEDIN", client, key)
+                        self.__negotiateCodec(key, info)
                     except e.NotUniqueUsernameError:
                         self.send("LOGINFAILED", client, key, "Username not unique!")
                     
                 elif command == "LOGIN": #Attempts to connect to database and match the hashed passwords
-                    username, password = info
-                    with self.__databaseLock:
-                        try:
-                            conn = sqlite3.connect("playerData.sqlite3")
-                            cur = conn.cursor()
-                        except:
-                            raise e.DatabaseAccessError
-                        cur.execute(f"SELECT password FROM Player WHERE username = '{username}';")
-                        try:
-                            passwordDB = cur.fetchone()[0]
-                        except:
-                            self.send("LOGINFAILED", client, key)
-                            conn.close()
-                            sys.exit()
-                    
-                        if passwordDB == password:
-                            failed = False
-                            self.send("LOGGEDIN", client, key)
-                            print(f"{address} logged in as {username}!")
-                        else:
-                            print(f"Login for {address} failed")
-                        conn.close()
-                    
-
-            #Creates statement fetching player, country and buff info. Some data repitition, but necessary to quicken loading timess
-            playerinfo = f"SELECT username, wins, losses, elo FROM Player WHERE username = '{username}';"
-            prioritycinfo = f"SELECT name, production, towns, type FROM Country WHERE playerID = '{username}' AND priority = 1;"
-            countryinfo = f"SELECT name, production, towns, type FROM Country WHERE playerID = '{username}';"
-            prioritybinfo = f"SELECT type from Buff WHERE playerID = '{username}' AND priority = 1;"
-            buffinfo = f"SELECT type from Buff WHERE playerID = '{username}';"
-            with self.__databaseLock:
-                try:
-                    conn = sqlite3.connect("playerData.sqlite3")
-                    cur = conn.cursor()
-                except:
-                    raise e.DatabaseAccessError
-                cur.execute(playerinfo) #execute the statements and load the data
-                pname, pwins, plosses, pelo = cur.fetchone()
-                cur.execute(countryinfo)
-                clist = []
-                for country in cur.fetchall():
-                    subclass = country[3]
-                    if subclass == "AGG":
-                        c = AggressiveCountry(country[0], country[1], country[2])
-                    elif subclass == "BAL":
-                        c = BalancedCountry(country[0], country[1], country[2])
-                    elif subclass == "DEF":
-                        c = DefensiveCountry(country[0], country[1], country[2])
-                    clist.append(c)
-                cur.execute(buffinfo)
-                blist = []
-                for buff in cur.fetchall():
-                    buff = buff[0]
-                    buff += "Buff()"
-                    b = eval(buff)
-                    blist.append(b)
-                cur.execute(prioritycinfo)
-                priorityclist = []
-                results = cur.fetchall()
-                for country in results:
-                    subclass = country[3]
-                    if subclass == "AGG":
-                        country = AggressiveCountry(country[0], country[1], country[2])
-                    elif subclass == "BAL":
-                        country = BalancedCountry(country[0], country[1], country[2])
-                    elif subclass == "DEF":
-                        country = DefensiveCountry(country[0], country[1], country[2])
-                    for c in clist:
-                        if hash(c) == hash(country):
-                            priorityclist.append(c)
-                cur.execute(prioritybinfo)
-                priorityblist = []
-                for buff in cur.fetchall():
-                    buff = buff[0]
-                    buff += "Buff()"
-                    buff = eval(buff)
-                    for b in blist:
-                        if hash(b) == hash(buff):
-                            priorityblist.append(b)
-                conn.close()
-
-            player = Player(pname, clist, priorityclist, blist, priorityblist, pwins, plosses, pelo, client, key)
-            thread = Thread(self.__handle, client, player) #Creates a handle thread
-            
-            self.__handlerThreads.append(thread)
-            thread.start() 
-            thread.join() #Waits for the thread to terminate (player sends LOGOUT request or stops responding)
+                    username, password = info[:2]
+                    loggedIn = self.__checkLogin(username, password)
+                    if loggedIn is None:
+                        self.send("LOGINFAILED", client, key)
+                        sys.exit()
+                    elif loggedIn:
+                        failed = False
+                        self.send("LOGGEDIN", client, key)
+                        self.__negotiateCodec(key, info)
+                        print(f"{address} logged in as {username}!")
+                    else:
+                        print(f"Login for {address} failed")
+
+            player = self.__loadPlayer(username, client, key)
+            self.__handle(client, player) #Handles the player on this thread until they send END or stop responding
+
+    def __exchangeKeys(self, client: socket.socket, data: bytes) -> SessionCipher: #RSA is only used here, to send the client a session key that encrypts everything afterwards
+        clientkey = rsa.PublicKey.load_pkcs1(data, "PEM")
+        cipher = SessionCipher.generate(initiator=False) #The client is the initiator
+        client.sendall(frame(rsa.encrypt(cipher.key, clientkey))) #Sends the session key, encrypted so only the client can read it. The server needs no keypair of its own
+        return cipher
+
+    def __checkLogin(self, username: str, password: str) -> bool or None: #Returns None if the account does not exist, otherwise whether the hashed passwords match
+        row = self.__database.queryOne("SELECT password FROM Player WHERE username = ?;", (username,))
+        if row is None:
+            return None
+        return row[0] == password
+
+    def __loadPlayer(self, username: str, client: socket.socket, key: SessionCipher) -> Player: #Loads the player and their inventory from the database
+        #Each card is read once along with its priority flag, so priority cards are picked out as they are built rather than matched by hash afterwards
+        playerinfo = "SELECT username, wins, losses, elo FROM Player WHERE username = ?;"
+        countryinfo = "SELECT name, production, towns, type, priority FROM Country WHERE playerID = ?;"
+        buffinfo = "SELECT type, priority FROM Buff WHERE playerID = ?;"
+        with self.__database.connection() as conn:
+            pname, pwins, plosses, pelo = conn.execute(playerinfo, (username,)).fetchone() #execute the statements and load the data
+            clist = []
+            priorityclist = []
+            for name, production, towns, subclass, priority in conn.execute(countryinfo, (username,)):
+                c = COUNTRYTYPES[subclass](name, production, towns)
+                clist.append(c)
+                if priority:
+                    priorityclist.append(c)
+            blist = []
+            priorityblist = []
+            for buffType, priority in conn.execute(buffinfo, (username,)):
+                b = BUFFTYPES[buffType]()
+                blist.append(b)
+                if priority:
+                    priorityblist.append(b)
+
+        return Player(pname, clist, priorityclist, blist, priorityblist, pwins, plosses, pelo, client, key)
 
     def __signup(self, username: str, password: int): #Attempts to sign up 
         print(f"Signing up {username}")
-        with self.__databaseLock:
-            try:
-                conn = sqlite3.connect("playerData.sqlite3") 
-                cur = conn.cursor()
-            except:
-                raise e.DatabaseAccessError
-            try:
-                query = f"INSERT INTO Player VALUES ('{username}', '{password}', 0, 0, 1000);" #Sets up and executes basic set up scripts for player accounts, creating the player entry
-                cur.execute(query)
-                conn.commit()
-                c1 = BalancedCountry("Angola", 25, 40) 
-                c2 = AggressiveCountry("Canada", 25, 40) 
-                query = "INSERT INTO Country (name, playerID, towns, type, production, priority, hash) VALUES " #and creating the base country entries
-                c1 = f"('Angola', '{username}', 40, 'BAL', 25, 1, {hash(c1)});"
-                c2 = f"('Canada', '{username}', 40, 'AGG', 25, 1, {hash(c2)});"
-                cur.execute(query + c1)
-                cur.execute(query + c2)
-                conn.commit()
-                b1 = MajorAttackBuff()
-                b2 = MajorProductionBuff()
-                query = "INSERT INTO Buff (type, playerID, priority, hash) VALUES " #and the base buff entries
-                b1 = f"('MajorAttack', '{username}', 1, {hash(b1)});"
-                b2 = f"('MinorTowns', '{username}', 1, {hash(b2)});"
-                cur.execute(query + b1)
-                cur.execute(query + b2)
-                conn.commit()
-                print(f"Successfully signed up {username}")
-                conn.close()
-            except sqlite3.IntegrityError:
-                print(f"{username} already exists")
-                raise e.NotUniqueUsernameError            
+        c1 = BalancedCountry("Angola", 25, 40) 
+        c2 = AggressiveCountry("Canada", 25, 40) 
+        b1 = MajorAttackBuff()
+        b2 = MinorTownsBuff()
+        def job(conn: sqlite3.Connection): #Sets up and executes basic set up scripts for player accounts in one job, so a failed sign up leaves nothing behind
+            conn.execute("INSERT INTO Player VALUES (?, ?, 0, 0, 1000);", (username, password)) #Creating the player entry
+            countryQuery = "INSERT INTO Country (name, playerID, towns, type, production, priority, hash) VALUES (?, ?, ?, ?, ?, 1, ?);" #and creating the base country entries
+            conn.execute(countryQuery, ("Angola", username, 40, "BAL", 25, hash(c1)))
+            conn.execute(countryQuery, ("Canada", username, 40, "AGG", 25, hash(c2)))
+            buffQuery = "INSERT INTO Buff (type, playerID, priority, hash) VALUES (?, ?, 1, ?);" #and the base buff entries
+            conn.execute(buffQuery, ("MajorAttack", username, hash(b1)))
+            conn.execute(buffQuery, ("MinorTowns", username, hash(b2)))
+        try:
+            self.__database.write(job) #Waits for the commit, as the player is loaded straight after
+        except sqlite3.IntegrityError:
+            print(f"{username} already exists")
+            raise e.NotUniqueUsernameError            
+        print(f"Successfully signed up {username}")
     
     def __handle(self, client: socket.socket, player: Player): #Function that handles each client
         print(f"Handling {player.username}")
         disconnectCounter = 0
-        while True:
-            if disconnectCounter >= 100:
-                print(f"{player.username} has disconnected")
-                client.close()
-                elo = player.elo
-                if elo <= 1000:
-                    pool = self.__pool1
-                elif elo <= 2000:
-                    pool = self.__pool2
-                elif elo <= 3000:
-                    pool = self.__pool3
-                else:
-                    pool = self.__pool4
+        try:
+            while True:
+                if disconnectCounter >= 100:
+                    print(f"{player.username} has disconnected")
+                    break
                 try:
-                    pool.remove(player)
+                    command, info = self.receive(client, player.key)
+                    print(command, loggable(command, info), " received in handle")
+                    if command == False:
+                        print("Unauthorized connection from ", client.getpeername()[0])
+                        break
+                    elif command == "DISCONNECT":
+                        print(f"{player.username} has disconnected unexpectedly")
+                        break
                 except:
-                    pass
-                break
-            try:
-                command, info = self.receive(client)
-                print(command, info, " received in handle")
-                if command == False:
-                    print("Unauthorized connection from ", client.getpeername()[0])
+                    continue
+                if not self.__handleCommand(client, player, command, info):
                     break
-                elif command == "DISCONNECT":
-                    print(f"{player.username} has disconnected unexpectedly")
+        finally: #However the session ended, take the player out of matchmaking, close their connection and write any priority changes still buffered
+            self.__removeFromPool(player)
+            client.close()
+            self.__flushPriorities(player)
+
+    def __handleCommand(self, client: socket.socket, player: Player, command: str, info: list) -> bool: #Performs a single command for a logged in player. Returns False once the session should end
+        if command == "END":
+            print(f"{player.username} has signed off") #Remove the player from any matchmaking pools and close the player connection
+            client.close()
+            self.__removeFromPool(player)
+            return False
+        elif command == "MATCHMAKE": #Add the player to the matchmaking pools
+            self.__flushPriorities(player) #The loadout is settled once the player matchmakes, so save it
+            self.__matchmakeInsert(player)
+        elif command == "UNMATCHMAKE": #Attempt to remove the player from the pools
+            self.__removeFromPool(player)
+        elif command == "DEPRIORITISECOUNTRY": 
+            self.__priorities.set(player.username, "Country", info[0], 0) #Deprioritise a country given the hash
+            for i in player.prioritycountries:
+                if hash(i) == info[0]:
+                    player.prioritycountries.remove(i) #Remove the country from the player priority countries list
                     break
-            except:
-                continue
-            if command == "END":
-                print(f"{player.username} has signed off") #Remove the player from any matchmaking pools and close the player connection
-                client.close()
-                elo = player.elo
-                if elo <= 1000:
-                    pool = self.__pool1
-                elif elo <= 2000:
-                    pool = self.__pool2
-                elif elo <= 3000:
-                    pool = self.__pool3
+        elif command == "PRIORITYCOUNTRY":
+            self.__priorities.set(player.username, "Country", info[0], 1) #Prioritise the country and add it to the priority countries list
+            for i in player.countries:
+                if hash(i) == info[0]:
+                    player.prioritycountries.append(i)
+                    break
+        elif command == "DEPRIORITISEBUFF": 
+            self.__priorities.set(player.username, "Buff", info[0], 0) #Deprioritise a buff
+            for i in player.buffs:
+                if hash(i) == info[0]:
+                    player.prioritybuffs.remove(i)
+                    break
+        elif command == "PRIORITYBUFF":
+            self.__priorities.set(player.username, "Buff", info[0], 1)
+            for i in player.buffs:
+                if hash(i) == info[0]:
+                    player.prioritybuffs.append(i)
+                    break
+        elif command == "RELAY": #A battle message for the player's enemy
+            self.__relayMessage(player, info)
+        elif command == "GETREWARDTUTORIAL":
+            self.getReward(client, player, tutorial=True) #Get the tutorial reward
+        
+        elif command == "GETREWARDWIN": #Get the reward if a battle was won
+            if player.Battle is not None and player.Battle.relay:
+                print(f"Relay stats for {player.Battle.player1} vs {player.Battle.player2}:", player.Battle.relayStats())
+            if player.Battle is not None:
+                newElo = self.__settleBattle(player, True)
+                self.__leaveBattle(player)
+                self.getReward(client, player)
+                self.send("ELO", client, player.key, newElo) #Sent straight after the reward, as framed messages cannot run into each other
+        elif command == "GETREWARDLOSS": #Get the reward if a battle was lost
+            if player.Battle is not None:
+                newElo = self.__settleBattle(player, False)
+                self.__leaveBattle(player)
+                num = random.random()
+                if num <= 0.3: #If the battle was lost, there is a 30% chance the loser gets a reward
+                    self.getReward(client, player)
                 else:
-                    pool = self.__pool4
+                    self.send("REWARD", client, player.key, None)
+                self.send("ELO", client, player.key, newElo)
+        return True
+
+    def __leaveBattle(self, player: Player): #Unlinks a player from their battle once they have reported its result, so nothing more is relayed for them and the reward cannot be claimed twice
+        player.Battle = None
+        player.enemy = None
+
+    def __settleBattle(self, player: Player, won: bool) -> int: #Applies a reported battle result to both players and queues it to be saved. Returns the player's new elo
+        winner, loser = (player, player.enemy) if won else (player.enemy, player)
+        if player.Battle.settle(winner, loser): #The first of the two reports decides the result, the second only reads the new elo
+            self.__results.record((winner.username, winner.elo, winner.wins, winner.losses), (loser.username, loser.elo, loser.wins, loser.losses))
+        return player.elo
+
+    def __relayMessage(self, player: Player, info: list): #Forwards a battle message to the player's enemy. It is still encrypted with the battle key, so it is passed on unread
+        started = time.perf_counter()
+        battle = player.Battle
+        enemy = player.enemy
+        if battle is None or not battle.relay or battle.settled or enemy is None or not info: #Once either player has reported the result the battle is over, so nothing more is passed on
+            return
+        message = info[0]
+        if type(message) is bytes and not self.__codec(enemy.key).binary: #Sent raw by a player on the binary codec, but json cannot carry bytes. Clients accept either form
+            message = base64.b64encode(message).decode("ascii")
+        elif type(message) is not bytes and type(message) is not str:
+            print(f"Dropped a relay message from {player.username} that was not bytes or base64")
+            return
+        try:
+            self.send("RELAY", enemy.socket, enemy.key, message)
+        except OSError: #The enemy has gone, which their client will report as a disconnect
+            return
+        except CodecError as error:
+            print(f"Could not relay a message from {player.username} to {enemy.username}: {error}")
+            return
+        battle.recordRelay(len(info[0]), time.perf_counter() - started)
+
+    def relayStats(self) -> dict: #Totals across relayed battles that are still in memory
+        battles = list(self.__relayedBattles)
+        return {"battles": len(battles), "messages": sum(b.relayed for b in battles), "bytes": sum(b.relayedBytes for b in battles)}
+
+    def __flushPriorities(self, player: Player): #Writes a player's buffered priority changes. A failure is reported but does not end the session, as the changes are kept for the next flush
+        try:
+            self.__priorities.flush(player.username)
+        except Exception as error:
+            print(f"Could not write priority changes for {player.username}: {error}")
+
+    def __removeFromPool(self, player: Player): #Removes the player from the matchmaking queue if they are waiting
+        self.__matchmaker.discard(player)
+
+    def __serveAsync(self): #Runs the event loop that serves every connection in async mode
+        print("Accepting Connections (async)")
+        asyncio.run(self.__listenAsync())
+
+    async def __listenAsync(self):
+        self.__sessionLimit = asyncio.Semaphore(self.__maxSessions) #Replaces the logged in lock, as sessions are coroutines rather than threads
+        server = await asyncio.start_server(self.__session, sock=self.__socket)
+        async with server:
+            await server.serve_forever()
+
+    async def __session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter): #Coroutine handling a single client for its whole connection
+        client = StreamSocket(reader, writer, asyncio.get_running_loop())
+        address = client.getpeername()
+        if self.__banList.isBanned(address[0]): #Checks if IP is banned
+            client.close()
+            return
+        print(f"Connection from {address} accepted!")
+        player = None
+        async with self.__sessionLimit:
+            try:
+                data = await readFrame(reader)
+                if data is None:
+                    return
+                key = await asyncio.get_running_loop().run_in_executor(self.__executor, self.__exchangeKeys, client, data) #Load the client key then send the server and session keys
+                player = await self.__loginAsync(client, key, address)
+                if player is not None:
+                    await self.__handleAsync(client, player)
+            except Exception as error: #Any failure only ends this session, the event loop keeps serving everyone else
+                print(f"Session for {address} ended: {error}")
+            finally:
+                if player is not None:
+                    self.__removeFromPool(player)
+                    await asyncio.get_running_loop().run_in_executor(self.__executor, self.__flushPriorities, player)
+                client.close()
+
+    async def __receiveAsync(self, client: StreamSocket, key: SessionCipher) -> tuple[str, str]: #Awaits a message. Decrypting with the session cipher is cheap enough to do on the event loop
+        try:
+            data = await readFrame(client.reader)
+        except (OSError, FrameError):
+            return "DISCONNECT", None
+        if data is None:
+            return "DISCONNECT", None
+        try:
+            return self.__decode(data, key)
+        except Exception as error:
+            print(f"Could not decode message from {client.getpeername()}: {error}")
+            return None, None
+
+    async def __sendAsync(self, command: str, client: StreamSocket, key: SessionCipher, *args): #Encrypts and sends a message without leaving the event loop
+        self.send(command, client, key, *args)
+
+    async def __loginAsync(self, client: StreamSocket, key: SessionCipher, address: tuple) -> Player or None: #The same as __login, returning the loaded player or None if the login failed
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.__sendAsync("LOGIN", client, key) #Sends login request
+            command, info = await self.__receiveAsync(client, key)
+            if command == False:
+                print("Unauthorized connection from ", address[0])
+                return None
+            elif command == "DISCONNECT":
+                return None
+            elif command == "SIGNUP":
+                username, password = info[:2]
                 try:
-                    pool.remove(player)
-                except:
-                    pass
+                    await loop.run_in_executor(self.__executor, self.__signup, username, password)
+                except e.NotUniqueUsernameError:
+                    await self.__sendAsync("LOGINFAILED", client, key, "Username not unique!")
+                    continue
+                await self.__sendAsync("LOGGEDIN", client, key)
+                self.__negotiateCodec(key, info)
+                break
+            elif command == "LOGIN":
+                username, password = info[:2]
+                loggedIn = await loop.run_in_executor(self.__executor, self.__checkLogin, username, password)
+                if loggedIn is None:
+                    await self.__sendAsync("LOGINFAILED", client, key)
+                    return None
+                elif loggedIn:
+                    await self.__sendAsync("LOGGEDIN", client, key)
+                    self.__negotiateCodec(key, info)
+                    print(f"{address} logged in as {username}!")
+                    break
+                print(f"Login for {address} failed")
+        return await loop.run_in_executor(self.__executor, self.__loadPlayer, username, client, key)
+
+    async def __handleAsync(self, client: StreamSocket, player: Player): #The same as __handle, but commands are awaited rather than blocking a thread
+        print(f"Handling {player.username}")
+        loop = asyncio.get_running_loop()
+        while True:
+            command, info = await self.__receiveAsync(client, player.key)
+            print(command, loggable(command, info), " received in handle")
+            if command == False:
+                print("Unauthorized connection from ", client.getpeername()[0])
+                break
+            elif command == "DISCONNECT":
+                print(f"{player.username} has disconnected unexpectedly")
+                break
+            elif command is None:
+                continue
+            elif command == "RELAY": #Forwarded straight from the event loop, as it is only a re-encryption
+                self.__relayMessage(player, info)
+                continue
+            if not await loop.run_in_executor(self.__executor, self.__handleCommand, client, player, command, info):
                 break
-            elif command == "MATCHMAKE": #Add the player to the matchmaking pools
-                self.__matchmakeInsert(player)
-            elif command == "UNMATCHMAKE": #Attempt to remove the player from the pools
-                elo = player.elo
-                if elo <= 1000:
-                    pool = self.__pool1
-                elif elo <= 2000:
-                    pool = self.__pool2
-                elif elo <= 3000:
-                    pool = self.__pool3
-                else:
-                    pool = self.__pool4
-                try:
-                    pool.remove(player)
-                except:
-                    pass
-            elif command == "DEPRIORITISECOUNTRY": 
-                with self.__databaseLock:
-                    try:
-                        conn = sqlite3.connect("playerData.sqlite3")
-                        cur = conn.cursor()
-                    except:
-                        raise e.DatabaseAccessError
-                    cur.execute(f"UPDATE Country SET priority = 0 WHERE hash = {info[0]} AND playerID = '{player.username}';") #Deprioritise a country given the hash
-                    conn.commit()
-                    conn.close()
-                for i in player.prioritycountries:
-                    if hash(i) == info[0]:
-                        player.prioritycountries.remove(i) #Remove the country from the player priority countries list
-                        break
-            elif command == "PRIORITYCOUNTRY":
-                with self.__databaseLock:
-                    try:
-                        conn = sqlite3.connect("playerData.sqlite3")
-                        cur = conn.cursor()
-                    except:
-                        raise e.DatabaseAccessError
-                    cur.execute(f"UPDATE Country SET priority = 1 WHERE hash = {info[0]} AND playerID = '{player.username}';") #Prioritise the country and add it to the priority countries list
-                    conn.commit()
-                    conn.close()
-                for i in player.countries:
-                    if hash(i) == info[0]:
-                        player.prioritycountries.append(i)
-                        break
-            elif command == "DEPRIORITISEBUFF": 
-                with self.__databaseLock:
-                    try:
-                        conn = sqlite3.connect("playerData.sqlite3")
-                        cur = conn.cursor()
-                    except:
-                        raise e.DatabaseAccessError
-                    cur.execute(f"UPDATE Buff SET priority = 0 WHERE hash = {info[0]} AND playerID = '{player.username}';") #Deprioritise a buff
-                    conn.commit()
-                    conn.close()
-                for i in player.buffs:
-                    if hash(i) == info[0]:
-                        player.prioritybuffs.remove(i)
-                        break
-            elif command == "PRIORITYBUFF":
-                with self.__databaseLock:
-                    try:
-                        conn = sqlite3.connect("playerData.sqlite3")
-                        cur = conn.cursor()
-                    except:
-                        raise e.DatabaseAccessError
-                    cur.execute(f"UPDATE Buff SET priority = 1 WHERE hash = {info[0]} AND playerID = '{player.username}';")
-                    conn.commit()
-                    conn.close()
-                for i in player.buffs:
-                    if hash(i) == info[0]:
-                        player.prioritybuffs.append(i)
-                        break
-            elif command == "GETREWARDTUTORIAL":
-                self.getReward(client, player, tutorial=True) #Get the tutorial reward
-            
-            elif command == "GETREWARDWIN": #Get the reward if a battle was won
-                if player.Battle is not None:
-                    probabilityOfWin = ELOCALC.calculateProbabilityOfWin(player.elo, player.enemy.elo)
-                    newElo = ELOCALC.calculateNewElo(player.elo, probabilityOfWin, 1)
-                    player.elo = newElo
-                    self.getReward(client, player)
-                    data = self.receive(client)
-                    while data[0] != "RECEIVED":
-                        data = self.receive(client) 
-                    self.send("ELO", client, player.key, newElo)
-            elif command == "GETREWARDLOSS": #Get the reward if a battle was lost
-                if player.Battle is not None:
-                    probabilityOfWin = ELOCALC.calculateProbabilityOfWin(player.elo, player.enemy.elo)
-                    newElo = ELOCALC.calculateNewElo(player.elo, probabilityOfWin, 0)
-                    num = random.random()
-                    if num <= 0.3: #If the battle was lost, there is a 30% chance the loser gets a reward
-                        self.getReward(client, player)
-                    else:
-                        self.send("REWARD", client, player.key, None)
-                    data = self.receive(client)
-                    while data[0] != "RECEIVED":
-                        data = self.receive(client) 
-                    self.send("ELO", client, player.key, newElo)
-                    player.elo = newElo
             
     def __matchmakeInsert(self, player: Player):
-        elo = player.elo 
-        if elo <= 1000: 
-            lock = self.__pool1Lock
-            pool = self.__pool1
-            poolnum = 1
-            print(f"{player.username} placed in pool 1")
-        elif elo <= 2000:
-            lock = self.__pool2Lock
-            pool = self.__pool2
-            poolnum = 2
-            print(f"{player.username} placed in pool 2")
-        elif elo <= 3000:
-            lock = self.__pool3Lock
-            pool = self.__pool3
-            poolnum = 3
-            print(f"{player.username} placed in pool 3")
-        else:
-            lock = self.__pool4Lock
-            pool = self.__pool4
-            poolnum = 4
-            print(f"{player.username} placed in pool 4")
-        with lock:
-            pos = self.__binaryPoolSearchInsert(pool, elo, 0, len(pool) - 1) #Gets the correct position using a binary search
-            if poolnum == 1:
-                self.__pool1 = pool[:pos] + [player] + pool[pos:]
-                print("Current pool1: ", self.__pool1)
-            elif poolnum == 2:
-                self.__pool2 = pool[:pos] + [player] + pool[pos:]
-                print("Current pool2: ", self.__pool2)
-            elif poolnum == 3:
-                self.__pool3 = pool[:pos] + [player] + pool[pos:]
-                print("Current pool3: ", self.__pool3)
-            elif poolnum == 4:
-                self.__pool4 = pool[:pos] + [player] + pool[pos:]
-                print("Current pool4: ", self.__pool4)
+        self.__matchmaker.add(player)
+        print(f"{player.username} queued for matchmaking at elo {player.elo}. {len(self.__matchmaker)} waiting")
+        with self.__matchmakeCondition: #Wake the matchmaker
+            self.__matchmakeCondition.notify()
+
+    def __queueReady(self) -> bool: #Whether enough players are waiting to matchmake, or the server is stopping
+        return self.__stopping.is_set() or len(self.__matchmaker) >= 2
 
     def __matchmake(self):
-        while True:
-            poolNum = random.randint(1, 4) #Matchmake a random player in a random pool
-            if poolNum == 1:
-                lock = self.__pool1Lock
-                pool = self.__pool1
-            elif poolNum == 2:
-                lock = self.__pool2Lock
-                pool = self.__pool2
-            elif poolNum == 3:
-                lock = self.__pool3Lock
-                pool = self.__pool3
-            else:
-                lock = self.__pool4Lock
-                pool = self.__pool4
-            with lock:
-                length = len(pool)
-                if length >= 2: #If less than two players in the pool, dont try and matchmake
-                    position = random.randint(0, length-1)
-                else:
-                    continue
-                print("MATCHMAKING")
-                player = pool[position]
-                value = player.elo
-                pool.remove(player)
-                opponent = self.__binarySearchMatchmake(pool, value, 0, len(pool)-1) #Get the player with the closest elo
-                pool.remove(opponent)
+        while not self.__stopping.is_set():
+            with self.__matchmakeCondition: #Sleeps until __matchmakeInsert signals that there are players to matchmake
+                self.__matchmakeCondition.wait_for(self.__queueReady)
+            pairs = self.__matchmaker.match() #Players whose windows do not overlap anyone yet stay queued until the next pass, when their windows are wider
+            if pairs:
+                self.__startBattles(pairs)
+            self.__stopping.wait(self.__matchmakeTick) #Waits before the next pass so players arriving close together are matched in the same pass
+
+    def __startBattles(self, pairs: list[tuple[Player, Player]]): #Sets up every battle from a matchmaking pass, then tells all the players at once
+        battles = []
+        for player, opponent in pairs:
             print(player, opponent, "are battling!")
-            self.send("MATCHMADE", player.socket, player.key) #Send confirmation to players that theyve been matchmade
-            self.send("MATCHMADE", opponent.socket, opponent.key)
-            battleThread = Thread(Battle, player, opponent) #Create a thread for a battle object and add to the list, then start the thread
-            self.__battleThreads.append(battleThread)
-            battleThread.start()
-
-    def __binarySearchMatchmake(self, pool: list[Player], value: int, first: int, last: int) -> Player:
-        if first > last: #Simple binary search to get player objects in a list
-            return pool[first]
-        else:
-            midpoint = (first + last) // 2
-            if pool[midpoint].elo == value:
-                return pool[midpoint]
-            elif pool[midpoint].elo < value:
-                first = midpoint + 1
-                return self.__binarySearchMatchmake(pool, value, first, last)
-            elif pool[midpoint].elo > value:
-                last = midpoint - 1
-                return self.__binarySearchMatchmake(pool, value, first, last)
-
-
-    def __binaryPoolSearchInsert(self, pool: list[Player], value: int, first: int, last: int) -> int: #binary search for insertion sort
-        if first > last: #Simple binary search to get an index in a list
-            return first
-        else:
-            midpoint = (first + last) // 2
-            if pool[midpoint].elo == value:
-                return midpoint + 1
-            elif pool[midpoint].elo < value:
-                first = midpoint + 1
-                return self.__binaryPoolSearchInsert(pool, value, first, last)
-            elif pool[midpoint].elo > value:
-                last = midpoint - 1
-                return self.__binaryPoolSearchInsert(pool, value, first, last)
-    
+            battle = Battle(player, opponent, self.__relay)
+            if self.__relay:
+                self.__relayedBattles.add(battle)
+            battles.append(battle)
+        self.__rendezvous.register(*battles) #The tokens must be valid before the players are told about them
+        for battle in battles:
+            for player in (battle.player1, battle.player2):
+                try:
+                    self.send("MATCHMADE", player.socket, player.key, battle.tokenFor(player)) #Send confirmation to players that theyve been matchmade, with the token to present to the rendezvous
+                except OSError as error: #The player has gone. Their opponent's setup connection will time out at the rendezvous
+                    print(f"Could not tell {player} about their battle: {error}")
+
+    def matchmakingStats(self) -> dict: #Returns the queue depth, time-to-match and elo gaps of matches
+        return self.__matchmaker.stats()
+
     def __generateName(self) -> str:
         return self.__CountryNames[random.randint(0, len(self.__CountryNames)-1)]
     
+    def __saveLater(self, query: str, parameters: tuple): #Queues a statement on the database writer without waiting for it, as the player object already holds the change
+        def reportFailure(future):
+            if future.exception() is not None:
+                print(f"Could not save {parameters}: {future.exception()}")
+        self.__database.submit(lambda conn: conn.execute(query, parameters)).add_done_callback(reportFailure)
+
     def getReward(self, client: socket.socket, player: Player, tutorial=False) -> list:
         towns = [30, 35, 40, 45, 50, 55, 60] #Generate lists of possible values for each statistic
         production = [20, 25, 30, 35, 40]
@@ -804,27 +1150,13 @@ class Server: #Class containing server methods and attributes
             name = self.__generateName()
             subclass = ["AGG", "BAL", "DEF"]
             subclass = subclass[random.randint(0, len(subclass)-1)]
-            if subclass == "AGG":
-                card = AggressiveCountry(name, production, towns)
-            elif subclass == "BAL":
-                card = BalancedCountry(name, production, towns)
-            elif subclass == "DEF":
-                card = DefensiveCountry(name, production, towns)
+            card = COUNTRYTYPES[subclass](name, production, towns)
             self.send("REWARD", client, player.key, "COUNTRY", name, towns, subclass, production) #Send the player the reward country
-            with self.__databaseLock:
-                try:
-                    conn = sqlite3.connect("playerData.sqlite3")
-                    cur = conn.cursor()
-                except:
-                    raise e.DatabaseAccessError
-                cur.execute(f"SELECT hash FROM Country WHERE playerID = '{player.username}';") #Get a list of hashes of the player countries and add it to the database if the country doesnt exist
-                hashList = cur.fetchall()
-                if hash(card) not in hashList:
-                    player.countries.append(card)
-                    query = "INSERT INTO Country (name, playerID, towns, type, production, priority, hash) VALUES "
-                    query += f"('{name}', '{player.username}', {towns}, '{subclass}', {production}, 0, {hash(card)});"
-                    cur.execute(query)
-                    conn.commit()
+            if hash(card) not in player.countryHashes: #Only add the country if the player does not already own it. The unique index makes the insert a no-op if it was already saved
+                player.countryHashes.add(hash(card))
+                player.countries.append(card)
+                query = "INSERT INTO Country (name, playerID, towns, type, production, priority, hash) VALUES (?, ?, ?, ?, ?, 0, ?) ON CONFLICT (playerID, hash) DO NOTHING;"
+                self.__saveLater(query, (name, player.username, towns, subclass, production, hash(card)))
         else: #30% chance the card is a buff
             subclass = random.random()
             if subclass > 0.3 or tutorial: #70% chance of it being a minor buff, or always if its a tutorial reward
@@ -833,23 +1165,13 @@ class Server: #Class containing server methods and attributes
                 subclass = "Major"
             stats = ["Towns", "Production", "Attack", "Defense", "SiegeAttack", "SiegeDefense", "Fortification"]
             stat = stats[random.randint(0, len(stats)-1)]
-            card = eval(subclass + stat + "Buff()")
+            card = BUFFTYPES[subclass + stat]()
             self.send("REWARD", client, player.key, "BUFF", subclass+stat) #Send the reward buff
-            with self.__databaseLock:
-                try:
-                    conn = sqlite3.connect("playerData.sqlite3")
-                    cur = conn.cursor()
-                except:
-                    raise e.DatabaseAccessError
-                cur.execute(f"SELECT hash FROM Buff WHERE playerID = '{player.username}';") #If the buff does not exist in the players account, add it
-                hashList = cur.fetchall()
-                if hash(card) not in hashList:
-                    player.buffs.append(card)
-                    query = "INSERT INTO Buff (type, priority, hash, playerID) VALUES "
-                    query += f"('{subclass+stat}', 0, {hash(card)}, '{player.username}');"
-                    cur.execute(query)
-                    conn.commit()
-        conn.close()
+            if hash(card) not in player.buffHashes: #If the buff does not exist in the players account, add it
+                player.buffHashes.add(hash(card))
+                player.buffs.append(card)
+                query = "INSERT INTO Buff (type, priority, hash, playerID) VALUES (?, 0, ?, ?) ON CONFLICT (playerID, hash) DO NOTHING;"
+                self.__saveLater(query, (subclass+stat, hash(card), player.username))
 
 class EloCalculator:
     "Class containing methods for calculating elo gain or loss"
@@ -876,5 +1198,13 @@ class EloCalculator:
 
 if __name__ == "__main__":
     ELOCALC = EloCalculator(2000, 24)
-    SERVER = Server()
-    
+    SERVER = Server(asyncMode="--async" in sys.argv, relay="--relay" in sys.argv) #Pass --async to serve connections from an event loop instead of a thread per client, and --relay to relay battles through the server
+    stopRequested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopRequested.set()) #Sent by kill, service managers and container runtimes, so it saves everything just as Ctrl+C does
+    try:
+        while not stopRequested.is_set():
+            time.sleep(1)
+    except KeyboardInterrupt: #Ctrl+C saves everything still buffered before exiting
+        pass
+    SERVER.shutdown()
+    os._exit(0) #Handler threads are blocked on their clients, so exit without waiting for them